@@ -1 +1,2 @@
 import numpy as np
+from airpollutionwatch.sources import retrieve_all
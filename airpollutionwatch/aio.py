@@ -0,0 +1,64 @@
+"""asyncioのサービスから使うための取得エンジン。
+
+取得はrequests_cacheの共有セッション(session.get_session())で行うので、
+ディスク上のHTTPキャッシュは同期版のretrieve()と共有される。
+ブロックする取得はスレッドで実行し、ホストごとのセマフォで同時接続数を、
+asyncio.wait_forで待ち時間を制限する。
+待ち時間を過ぎてもスレッドは止められないので、セマフォはスレッドが終わるまで返さない。
+スレッドが止まったままにならないように、HTTPの要求にはsession.TIMEOUTがかかる。
+(aiohttpなどの非同期クライアントにすると、HTTPキャッシュを共有できなくなる。)
+"""
+
+import asyncio
+import functools
+import weakref
+
+# 1つのホストに同時に送るリクエストの数の既定値
+PER_HOST = 2
+# 1回の取得を待つ秒数
+TIMEOUT = 60
+
+# ホストごとの同時接続数。limit()で変えられる。
+limits = {}
+
+# イベントループごと、ホストごとのセマフォ
+_semaphores = weakref.WeakKeyDictionary()
+
+
+def limit(host, n):
+    """hostへの同時接続数をnにする。"""
+    limits[host] = n
+    for semaphores in _semaphores.values():
+        semaphores.pop(host, None)
+
+
+def _semaphore(host):
+    loop = asyncio.get_running_loop()
+    semaphores = _semaphores.setdefault(loop, {})
+    if host not in semaphores:
+        semaphores[host] = asyncio.Semaphore(limits.get(host, PER_HOST))
+    return semaphores[host]
+
+
+def _release(semaphore, future):
+    semaphore.release()
+    # 待つのをやめたあとに失敗した場合、例外を取りだしておかないと警告が出る。
+    if not future.cancelled():
+        future.exception()
+
+
+async def run(host, func, *args, timeout=TIMEOUT, **kwargs):
+    """func(*args, **kwargs)をhostの同時接続数の範囲内でスレッドで実行する。
+
+    timeout秒を過ぎるとasyncio.TimeoutErrorになるが、スレッドが終わるまでは
+    hostの同時接続数に数える。
+    """
+    semaphore = _semaphore(host)
+    await semaphore.acquire()
+    try:
+        future = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+    except BaseException:
+        semaphore.release()
+        raise
+    future.add_done_callback(functools.partial(_release, semaphore))
+    return await asyncio.wait_for(asyncio.shield(future), timeout)
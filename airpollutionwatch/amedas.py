@@ -2,14 +2,23 @@ import sys
 
 sys.path.insert(0, "..")  # for debug
 
-import io
 import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 # import requests
-import requests_cache
 import pandas as pd
 import numpy as np
-from airpollutionwatch.convert import TEMP, HUM, CODE, LON, LAT, WD, WS
+from airpollutionwatch.session import get_session, base_url, expire_after
+from airpollutionwatch.fastjson import loads, records
+from airpollutionwatch.memo import ttl_cache, METADATA_TTL
+from airpollutionwatch import batch, aio, framecache, instrument
+from airpollutionwatch.convert import TEMP, HUM, CODE, LON, LAT, WD, WS, compacted
+
+# データの置かれている場所。session.override_base_url("amedas", url)で変えられる。
+BASE_URL = "https://www.jma.go.jp/bosai/amedas"
+
+# データの置かれているホスト。aioでの同時接続数の制限に使う。
+HOST = "www.jma.go.jp"
 
 # apparent nameと内部標準名(そらまめ名)の変換
 converters = {
@@ -37,58 +46,293 @@ converters = {
     "code": lambda x: CODE(x),
 }
 
+# 地図データから取りだす要素。値と品質の組になっている。
+ITEMS = ("temp", "humidity", "wind", "windDirection")
 
-def retrieve_raw(isotime):
-    """指定された日時のデータを入手する。index名とcolumn名は生のまま。"""
+# 地図データが公開される間隔
+INTERVAL = datetime.timedelta(minutes=10)
+
+# 1時間の10分ごとのデータの数
+SNAPSHOTS = 6
+
+# 地点ごとのデータは、この時間数ずつ1つのファイルになっている。
+POINT_HOURS = 3
+
+
+def request(isotime):
+    """指定された日時の地図データを取得し、応答を返す。
+
+    地図データは10分ごとにあるので、分は10の倍数で指定する。
+    """
     dt = datetime.datetime.fromisoformat(isotime)
-    date_time = dt.strftime("%Y%m%d%H0000")
+    date_time = dt.strftime("%Y%m%d%H%M00")
 
-    session = requests_cache.CachedSession("airpollution")
-    response = session.get(
-        f"https://www.jma.go.jp/bosai/amedas/data/map/{date_time}.json",
+    session = get_session("amedas")
+    return session.get(
+        f"{base_url('amedas', BASE_URL)}/data/map/{date_time}.json",
+        expire_after=expire_after(isotime),
     )
+
+
+@instrument.timed("retrieve_raw", "amedas")
+def retrieve_raw(isotime):
+    """指定された日時のデータを入手する。index名とcolumn名は生のまま。"""
+    response = request(isotime)
     # これがないと文字化けする
     # response.encoding = response.apparent_encoding
 
-    dfs = pd.read_json(io.StringIO(response.text), orient="index")
+    dfs = records(response.content)
     return dfs
 
 
-def retrieve(isotime):
-    """指定された日時のデータを入手する。index名とcolumn名をつけなおし、単位をそらまめにあわせる。"""
-    df = retrieve_raw(isotime)
-    # print(df.iloc[0])
-    session = requests_cache.CachedSession("airpollution")
-    response = session.get(
-        f"https://www.jma.go.jp/bosai/amedas/const/amedastable.json",
+@ttl_cache(METADATA_TTL)
+def _station_table():
+    response = get_session("amedas").get(
+        f"{base_url('amedas', BASE_URL)}/const/amedastable.json",
     )
-    amedas = pd.read_json(io.StringIO(response.text), orient="index")
-
-    df = pd.merge(df, amedas, left_index=True, right_index=True, how="left")
+    df = records(response.content)
     # 度分を度に変換
-    df["lon"] = [x[0] + x[1] / 60 for x in df["lon"]]
-    df["lat"] = [x[0] + x[1] / 60 for x in df["lat"]]
-    # 第2項目の意味がわからない。
-    # print(df.iloc[0]["temp"][0])
-    for item in ("temp", "humidity", "wind", "windDirection"):
-        temp = []
-        for t in df[item]:
-            if type(t) is list:
-                temp.append(t[0])
-                # 2番目の項目の意味不明。単位指定か?
-            else:
-                temp.append(t)
-        df[item] = temp
-    df["code"] = df.index
-
-    # print(df.columns)
-    # print(df["windDirection"])
+    lon = np.array(df["lon"].tolist(), dtype=float)
+    lat = np.array(df["lat"].tolist(), dtype=float)
+    table = pd.DataFrame(
+        {
+            "lon": lon[:, 0] + lon[:, 1] / 60,
+            "lat": lat[:, 0] + lat[:, 1] / 60,
+            "alt": pd.to_numeric(df["alt"], errors="coerce"),
+        },
+        index=df.index,
+    )
+    return framecache.fingerprint(response), table
+
+
+def station_table():
+    """地点表。地点番号(文字列)をindexとし、経度緯度(度)と標高(m)を持つ。一定時間メモしておく。"""
+    return _station_table()[1]
+
+
+def block(data, items=ITEMS):
+    """{地点番号: {要素: [値, 品質]}}を、地点×要素の値と品質の配列にする。
+
+    地点番号のリスト、値のfloat64の2次元配列、品質のfloat64の2次元配列を返す。
+    ないものはNaNになる。
+    """
+    columns = {item: j for j, item in enumerate(items)}
+    rows = []
     cols = []
-    for col in df.columns:
-        if col in converters:
-            cols.append(converters[col](df[col]))
-    return pd.concat(cols, axis=1).set_index("code")
-    # return df
+    cells = []
+    for i, record in enumerate(data.values()):
+        for item, cell in record.items():
+            j = columns.get(item)
+            if j is not None:
+                rows.append(i)
+                cols.append(j)
+                # 品質のついていない値もあるかもしれない。
+                cells.append(cell if type(cell) is list else (cell, None))
+    pairs = np.array(cells, dtype=float).reshape(-1, 2)
+    values = np.full((len(data), len(items)), np.nan)
+    quality = np.full((len(data), len(items)), np.nan)
+    values[rows, cols] = pairs[:, 0]
+    quality[rows, cols] = pairs[:, 1]
+    return list(data), values, quality
+
+
+@instrument.timed("retrieve_raw", "amedas")
+def fetch_block(isotime, key):
+    """retrieve()の取得と解析。(目印, DataFrameかNone, block()の結果かNone)を返す。
+
+    keyと応答が前回と同じならframecacheのDataFrameを返し、解析はしない。
+    """
+    response = request(isotime)
+    mark, df = framecache.lookup(key, response)
+    if df is not None:
+        return mark, df, None
+    return mark, None, block(loads(response.content))
+
+
+@instrument.timed("retrieve", "amedas")
+def retrieve(isotime, compact=False):
+    """指定された日時のデータを入手する。index名とcolumn名をつけなおし、単位をそらまめにあわせる。
+
+    各要素の品質フラグは、"<要素名>_quality"の列(Int8)に入れる。
+    compactにTrueか"scaled"を与えると、convert.compacted()で型を小さくする。
+    """
+    fingerprint, table = _station_table()
+    # 地図データも地点表も前回と同じなら、解析も変換もしない。
+    key = ("amedas", isotime, compact, fingerprint)
+    mark, df, parsed = fetch_block(isotime, key)
+    if df is not None:
+        return df
+
+    codes, values, quality = parsed
+    codes = pd.Index(codes)
+    cols = _columns(values, quality, table.reindex(codes))
+    cols.append(converters["code"](pd.Series(codes)))
+    df = compacted(pd.concat(cols, axis=1).set_index("code"), compact)
+    framecache.store(key, mark, df)
+    return df
+
+
+def _columns(values, quality, located):
+    # block()の値と品質、各行の地点表から、そらまめにあわせた列を作る。
+    cols = [converters[item](pd.Series(values[:, j])) for j, item in enumerate(ITEMS)]
+    cols += [
+        pd.Series(quality[:, j], name=f"{col.name}_quality").astype("Int8")
+        for j, col in enumerate(list(cols))
+    ]
+    cols.append(converters["lon"](pd.Series(located["lon"].to_numpy())))
+    cols.append(converters["lat"](pd.Series(located["lat"].to_numpy())))
+    return cols
+
+
+async def aretrieve(isotime, compact=False):
+    """retrieve()のasyncio版。HOSTへの同時接続数はaioで制限される。"""
+    return await aio.run(HOST, retrieve, isotime, compact=compact)
+
+
+def retrieve_range(
+    start, end, max_workers=batch.MAX_WORKERS, compact=False, errors="raise"
+):
+    """startからendまでの毎時のデータを並行して入手し、(time, code)をindexとする1つのDataFrameにまとめる。
+
+    errorsは取得に失敗した時刻の扱い。batch.retrieve_range()を参照。
+    """
+    return batch.retrieve_range(
+        retrieve,
+        start,
+        end,
+        max_workers=max_workers,
+        compact=compact,
+        errors=errors,
+        index_name="code",
+    )
+
+
+def retrieve_snapshots(
+    start, end, max_workers=batch.MAX_WORKERS, compact=True, errors="raise"
+):
+    """startからendまでの10分ごとのデータを並行して入手し、(time, code)をindexとする1つのDataFrameにまとめる。
+
+    毎時の6倍の行数になるので、既定ではconvert.compacted()で型を小さくする。
+    hourly()で毎時のデータにまとめられる。
+    """
+    return batch.retrieve_range(
+        retrieve,
+        start,
+        end,
+        max_workers=max_workers,
+        compact=compact,
+        step=INTERVAL,
+        errors=errors,
+        index_name="code",
+    )
+
+
+def point_block(isotime):
+    """isotimeを含む、地点ごとのファイルの最初の時刻(datetime)。"""
+    dt = datetime.datetime.fromisoformat(isotime)
+    return dt.replace(
+        hour=dt.hour - dt.hour % POINT_HOURS, minute=0, second=0, microsecond=0
+    )
+
+
+def request_point(code, isotime):
+    """地点codeの、isotimeを含む3時間分のファイルを取得し、応答を返す。"""
+    first = point_block(isotime)
+    last = first + datetime.timedelta(hours=POINT_HOURS)
+    return get_session("amedas").get(
+        f"{base_url('amedas', BASE_URL)}/data/point/{code}/{first:%Y%m%d_%H}.json",
+        expire_after=expire_after(last.isoformat()),
+    )
+
+
+@instrument.timed("retrieve_point", "amedas")
+def retrieve_point(code, isotime):
+    """地点codeの、isotimeを含む3時間分の10分ごとのデータを入手する。timeをindexとする。"""
+    response = request_point(code, isotime)
+    times, values, quality = block(loads(response.content))
+    located = station_table().reindex([str(code)] * len(times))
+    cols = _columns(values, quality, located)
+    index = pd.to_datetime(times, format="%Y%m%d%H%M%S")
+    index = index.tz_localize(point_block(isotime).tzinfo).rename("time")
+    return pd.concat(cols, axis=1).set_index(index)
+
+
+def retrieve_points(codes, start, end, max_workers=batch.MAX_WORKERS, compact=True):
+    """地点codesの、startからendまでの10分ごとのデータを並行して入手し、
+
+    (time, code)をindexとする1つのDataFrameにまとめる。
+    全国の地図データを取らずに地点ごとのファイル(3時間分ずつ)を取るので、
+    少ない地点の長い期間に向く。hourly()で毎時のデータにまとめられる。
+    """
+    blocks = batch.hours(
+        point_block(start).isoformat(),
+        end,
+        datetime.timedelta(hours=POINT_HOURS),
+    )
+    jobs = [(code, t) for code in codes for t in blocks]
+    # 地点表は、スレッドがそれぞれ取りにいかないように先に読んでおく。
+    station_table()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        frames = list(executor.map(lambda job: retrieve_point(*job), jobs))
+    df = pd.concat(frames, keys=[int(code) for code, _ in jobs], names=["code"])
+    df = df.swaplevel().sort_index()
+    times = df.index.get_level_values("time")
+    df = df[(pd.Timestamp(start) <= times) & (times <= pd.Timestamp(end))]
+    return compacted(df, compact)
+
+
+def _floats(series):
+    return series.to_numpy(dtype=float, na_value=np.nan)
+
+
+def hourly(df, min_count=SNAPSHOTS):
+    """retrieve_snapshots()の10分ごとのデータを、毎時のデータにまとめる。
+
+    そらまめにあわせて、時刻はその1時間の終わりにする(02:10から03:00までを03:00とする)。
+    TEMP, HUM, WSは平均、WS_maxは10分間平均風速の最大(最大風速)、
+    WDとWS_vectorは風向・風速をベクトル平均したもの、品質フラグは最大をとる。
+    countはその1時間の10分ごとのデータの数で、min_countより少ない時間は落とす。
+    期間の端の時間は、既定ではそろっていないので出さない。
+    """
+    times = df.index.get_level_values("time")
+    # resample(closed="right", label="right")と同じく、正時ちょうどはその時間に含める。
+    keys = [times.ceil("h"), df.index.get_level_values("code")]
+
+    ws = _floats(df["WS"])
+    # 16方位を角度に。0は静穏で、風速も0なので向きは効かない。
+    theta = np.deg2rad(_floats(df["WD"]) * 22.5)
+    frame = pd.DataFrame(
+        {
+            "TEMP": _floats(df["TEMP"]),
+            "HUM": _floats(df["HUM"]),
+            "WS": ws,
+            "u": -ws * np.sin(theta),
+            "v": -ws * np.cos(theta),
+        }
+    )
+    grouped = frame.groupby(keys)
+    out = grouped[["TEMP", "HUM", "WS"]].mean()
+    out["WS_max"] = grouped["WS"].max()
+
+    u = grouped["u"].mean().to_numpy()
+    v = grouped["v"].mean().to_numpy()
+    speed = np.hypot(u, v)
+    # 風の吹いてくる方向を16方位に。北は16、静穏は0。
+    code = np.round(np.rad2deg(np.arctan2(-u, -v)) / 22.5) % 16
+    code = np.where(code == 0, 16, code)
+    code = np.where(speed == 0, 0, code)
+    out["WD"] = pd.array(np.where(np.isnan(speed), np.nan, code)).astype("Int8")
+    out["WS_vector"] = speed
+
+    flags = [col for col in df.columns if col.endswith("_quality")]
+    if flags:
+        quality = df[flags].reset_index(drop=True).groupby(keys).max()
+        out[flags] = quality.astype("Int8")
+    located = df[["lon", "lat"]].reset_index(drop=True).groupby(keys).first()
+    out[["lon", "lat"]] = located.astype(float)
+    out["count"] = grouped.size()
+    out.index.names = ["time", "code"]
+    return out[out["count"] >= min_count]
 
 
 def test():
@@ -0,0 +1,181 @@
+"""変換済みの毎時データをParquetで保存し、期間と測定局と項目を指定して読みだす。
+
+保存先は取得元と年月で分けたディレクトリ。
+    root/source=tokyo/year=2024/month=08/xxxxxxxx.parquet
+読みだすときは期間にかかる年月のファイルだけを開き、要る列だけを読む。
+pyarrowが必要(pip install airpollutionwatch[archive])。
+"""
+
+import os
+import time
+import uuid
+from glob import glob
+from logging import getLogger
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from airpollutionwatch.convert import compacted
+
+# 保存先の既定値
+ROOT = "airpollution-archive"
+
+TZ = "Asia/Tokyo"
+
+# 保存する項目。そらまめの単位にそろえたもの。
+ITEMS = [
+    "SO2",
+    "NO",
+    "NO2",
+    "NOX",
+    "OX",
+    "SPM",
+    "PM25",
+    "NMHC",
+    "CH4",
+    "THC",
+    "CO",
+    "WD",
+    "WS",
+    "TEMP",
+    "HUM",
+]
+
+SCHEMA = pa.schema(
+    [("time", pa.timestamp("ns", tz=TZ)), ("station", pa.int64())]
+    + [(item, pa.int8() if item == "WD" else pa.float64()) for item in ITEMS]
+)
+
+
+def timestamp(isotime):
+    t = pd.Timestamp(isotime)
+    if t.tzinfo is None:
+        return t.tz_localize(TZ)
+    return t.tz_convert(TZ)
+
+
+def _months(start, end):
+    """startからendまでにかかる(年, 月)。"""
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+
+def _partition(root, source, year, month):
+    return os.path.join(root, f"source={source}", f"year={year}", f"month={month:02d}")
+
+
+def append(df, source, root=ROOT):
+    """retrieve_range()の結果((time, 局番)をindexとするDataFrame)を保存する。
+
+    国環研局番(AMeDASでは地点番号)が整数にならない測定局は保存しない。
+    書きこんだ行数を返す。
+    """
+    logger = getLogger()
+    names = list(df.index.names)
+    if len(names) != 2 or names[0] != "time" or names[1] not in ("station", "code"):
+        raise ValueError(
+            f"{source}: index must be (time, station) or (time, code), not {names}."
+        )
+    if names[1] != "station" and "station" in df.columns:
+        raise ValueError(f"{source}: both the index and a column are named station.")
+    df = df.reset_index().rename(columns={names[1]: "station"})
+
+    station = pd.to_numeric(df["station"], errors="coerce")
+    unresolved = station.isna()
+    if unresolved.any():
+        names = sorted(set(df["station"][unresolved].astype(str)))
+        logger.warning(f"{source}: {len(names)} stations are not archived: {names}")
+    df = df[~unresolved].assign(station=station[~unresolved].astype("int64"))
+
+    df["time"] = pd.to_datetime(df["time"])
+    if df["time"].dt.tz is None:
+        df["time"] = df["time"].dt.tz_localize(TZ)
+    else:
+        df["time"] = df["time"].dt.tz_convert(TZ)
+    for item in ITEMS:
+        if item not in df:
+            df[item] = pd.NA if item == "WD" else float("nan")
+    df = df[SCHEMA.names]
+
+    for (year, month), part in df.groupby([df["time"].dt.year, df["time"].dt.month]):
+        directory = _partition(root, source, year, month)
+        os.makedirs(directory, exist_ok=True)
+        table = pa.Table.from_pandas(part, schema=SCHEMA, preserve_index=False)
+        # ファイル名の順が書きこんだ順になるようにする。
+        name = f"{time.time_ns()}-{uuid.uuid4().hex[:8]}.parquet"
+        pq.write_table(table, os.path.join(directory, name))
+    return len(df)
+
+
+def list_sources(root=ROOT):
+    """保存されている取得元の名前。"""
+    return sorted(
+        os.path.basename(path).split("=", 1)[1]
+        for path in glob(os.path.join(root, "source=*"))
+    )
+
+
+def files(start, end, sources=None, root=ROOT):
+    """期間にかかる年月のParquetファイルを、取得元ごとに返す。"""
+    start, end = timestamp(start), timestamp(end)
+    result = {}
+    for source in list_sources(root) if sources is None else sources:
+        paths = []
+        for year, month in _months(start, end):
+            paths += sorted(
+                glob(os.path.join(_partition(root, source, year, month), "*.parquet"))
+            )
+        if paths:
+            result[source] = paths
+    return result
+
+
+def hours(source, start, end, root=ROOT):
+    """取得元sourceについて、startからendまでに保存されている時刻の集合。"""
+    t0, t1 = timestamp(start), timestamp(end)
+    paths = files(t0, t1, sources=[source], root=root).get(source)
+    if not paths:
+        return set()
+    field = ds.field("time")
+    table = ds.dataset(paths, schema=SCHEMA, format="parquet").to_table(
+        columns=["time"],
+        filter=(field >= pa.scalar(t0, type=SCHEMA.field("time").type))
+        & (field <= pa.scalar(t1, type=SCHEMA.field("time").type)),
+    )
+    return set(table.column("time").unique().to_pandas())
+
+
+def read(start, end, stations=None, items=None, sources=None, root=ROOT, compact=False):
+    """startからendまで(両端を含む)のデータを読む。
+
+    stationsに局番のリストを与えるとその測定局だけ、itemsに項目名のリストを与えるとその列だけを読む。
+    (time, station)をindexとし、取得元をsource列に入れたDataFrameを返す。
+    同じ時刻と測定局が何度も保存されていたら、あとから保存したほうを使う。
+    compactにTrueか"scaled"を与えると、convert.compacted()で型を小さくする。
+    """
+    t0, t1 = timestamp(start), timestamp(end)
+    columns = ["time", "station"] + list(ITEMS if items is None else items)
+    condition = (ds.field("time") >= pa.scalar(t0, type=SCHEMA.field("time").type)) & (
+        ds.field("time") <= pa.scalar(t1, type=SCHEMA.field("time").type)
+    )
+    if stations is not None:
+        condition &= ds.field("station").isin([int(x) for x in stations])
+
+    frames = []
+    for source, paths in files(t0, t1, sources=sources, root=root).items():
+        table = ds.dataset(paths, schema=SCHEMA, format="parquet").to_table(
+            columns=columns, filter=condition
+        )
+        df = table.to_pandas(types_mapper={pa.int8(): pd.Int8Dtype()}.get)
+        frames.append(df.assign(source=source))
+    if not frames:
+        return pd.DataFrame(columns=columns + ["source"]).set_index(["time", "station"])
+
+    df = pd.concat(frames, ignore_index=True)
+    df = df.drop_duplicates(["source", "time", "station"], keep="last")
+    df = df.sort_values(["time", "station"]).set_index(["time", "station"])
+    return compacted(df, compact)
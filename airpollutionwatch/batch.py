@@ -0,0 +1,73 @@
+"""ある期間の毎時のデータを並行して入手する。"""
+
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+import pandas as pd
+
+from airpollutionwatch.convert import compacted
+
+# 1つの取得元に同時に送るリクエストの数の既定値
+MAX_WORKERS = 4
+
+
+def hours(start, end, step=datetime.timedelta(hours=1)):
+    """startからend(両端を含む)までのisotimeをstepおきに並べる。"""
+    dt = datetime.datetime.fromisoformat(start)
+    last = datetime.datetime.fromisoformat(end)
+    times = []
+    while dt <= last:
+        times.append(dt.isoformat())
+        dt += step
+    return times
+
+
+def retrieve_range(
+    retrieve,
+    start,
+    end,
+    max_workers=MAX_WORKERS,
+    compact=False,
+    step=datetime.timedelta(hours=1),
+    errors="raise",
+    index_name="station",
+    **kwargs,
+):
+    """retrieve(isotime, **kwargs)をstartからendまでのstepおきの各時刻について並行して呼び、
+
+    (time, 局番)をindexとする1つのDataFrameにまとめる。
+    compactはconvert.compacted()に渡す。まとめたあとで1回だけ型を小さくする。
+    取得に失敗した時刻は、どれもログに書く。errors="raise"なら最初に失敗した時刻の例外を投げ、
+    errors="skip"ならその時刻を飛ばして残りをまとめる。
+    期間が空(start > end)か、すべての時刻を飛ばした場合は、(time, index_name)をindexとする
+    行のないDataFrameを返す。
+    """
+    assert errors in ("raise", "skip"), f"unknown errors {errors}"
+    logger = getLogger()
+    times = hours(start, end, step)
+
+    def attempt(t):
+        try:
+            return retrieve(t, **kwargs), None
+        except Exception as e:
+            logger.warning(f"{t}: {e!r}")
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(attempt, times))
+
+    frames = {}
+    for t, (df, error) in zip(times, results):
+        if error is None:
+            frames[pd.Timestamp(t)] = df
+        elif errors == "raise":
+            raise error
+    if not frames:
+        index = pd.MultiIndex.from_arrays(
+            [pd.DatetimeIndex([], tz=pd.Timestamp(start).tz), []],
+            names=["time", index_name],
+        )
+        return pd.DataFrame(index=index)
+    df = pd.concat(list(frames.values()), keys=list(frames), names=["time"])
+    return compacted(df, compact)
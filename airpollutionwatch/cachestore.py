@@ -0,0 +1,89 @@
+"""HTTPキャッシュの置き場所と保存形式。
+
+session.configure(backend=...)で選ぶ。
+    sqlite      requests_cacheの既定のSQLite。書きこみは1つずつ。
+    wal         SQLiteをWALモードで使う。読みだしが書きこみを待たない。複数プロセス向き。
+    mmap        walに加えて、読みだしをメモリマップでする。大きなキャッシュの参照が速い。
+    filesystem  URLごとに1つの圧縮したファイル。置きかえで書くので、読み手が書きかけを見ない。
+    memory      プロセス内のメモリ。
+置き場所はsession.configure(cache_dir=...)か、環境変数AIRPOLLUTIONWATCH_CACHE_DIRで決める。
+session.configure(shard=True)にすると、取得元ごとに別のキャッシュを使う。
+"""
+
+import os
+import pickle
+import tempfile
+import zlib
+
+from requests_cache import SQLiteCache
+from requests_cache.backends.filesystem import FileCache, FileDict
+from requests_cache.serializers import SerializerPipeline, Stage
+from requests_cache.serializers.preconf import base_stage
+
+BACKENDS = ("sqlite", "wal", "mmap", "filesystem", "memory")
+
+# 別のプロセスが書いている間、SQLiteが待つ時間(ミリ秒)
+BUSY_TIMEOUT = 30000
+
+# mmapで使うメモリマップの大きさ(バイト)
+MMAP_SIZE = 2**30
+
+# pickleしてzlibで圧縮する。毎時のJSONやHTMLは1/5から1/10になる。
+compressed_serializer = SerializerPipeline(
+    [base_stage, Stage(pickle), Stage(dumps=zlib.compress, loads=zlib.decompress)],
+    name="pickle+zlib",
+    is_binary=True,
+)
+
+
+def cache_dir(directory=None):
+    """キャッシュを置くディレクトリ。"""
+    return directory or os.environ.get("AIRPOLLUTIONWATCH_CACHE_DIR") or ""
+
+
+class AtomicFileDict(FileDict):
+    """一時ファイルに書いてから置きかえるFileDict。
+
+    ほかのプロセスが同じURLを同時に読み書きしても、書きかけのファイルは見えない。
+    """
+
+    def __setitem__(self, key, value):
+        path = self._key2path(key)
+        with self._try_io(key):
+            fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(self.serialize(value))
+                os.replace(tmp, path)
+            except BaseException:
+                os.unlink(tmp)
+                raise
+
+
+class CompressedFileCache(FileCache):
+    """URLごとに1つの圧縮したファイルに保存するキャッシュ。"""
+
+    def __init__(self, cache_name, **kwargs):
+        kwargs.setdefault("serializer", compressed_serializer)
+        super().__init__(cache_name, **kwargs)
+        self.responses = AtomicFileDict(
+            cache_name, serializer=kwargs["serializer"], lock=self.responses.lock
+        )
+
+
+def backend(kind, path):
+    """kindの保存形式で、pathにキャッシュを置くrequests_cacheのbackendを作る。
+
+    sqliteとmemoryはrequests_cacheにそのまま名前を渡せばよいので、名前を返す。
+    """
+    assert kind in BACKENDS, f"unknown cache backend {kind}"
+    if kind in ("sqlite", "memory"):
+        return kind
+    if kind == "filesystem":
+        return CompressedFileCache(path)
+    cache = SQLiteCache(path, wal=True, busy_timeout=BUSY_TIMEOUT)
+    if kind == "mmap":
+        for table in (cache.responses, cache.redirects):
+            with table.connection() as con:
+                con.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+    return cache
@@ -2,12 +2,12 @@ import sys
 
 sys.path.insert(0, "..")  # for debug
 
-import io
 import datetime
 from logging import getLogger, basicConfig, INFO, DEBUG
-import requests_cache
 import pandas as pd
 import numpy as np
+from airpollutionwatch.session import get_session, base_url, expire_after
+from airpollutionwatch import batch, aio, htmltable, instrument
 
 # try:
 from airpollutionwatch.convert import (
@@ -27,6 +27,7 @@ from airpollutionwatch.convert import (
     TEMP,
     HUM,
     STATION,
+    compacted,
 )
 
 # except:
@@ -50,6 +51,15 @@ from airpollutionwatch.convert import (
 #     )
 
 
+# データの置かれている場所。session.override_base_url("chiba", url)で変えられる。
+BASE_URL = "https://air.taiki.pref.chiba.lg.jp/hourreport"
+
+# データの置かれているホスト。aioでの同時接続数の制限に使う。
+HOST = "air.taiki.pref.chiba.lg.jp"
+
+# 都道府県コード(千葉県)。測定局名はまずこの中で探す。
+PREF = 12
+
 # ウェブ上の表記と、国環研の表記との対応
 aliases = {
     "野田宮崎": "国設野田",
@@ -91,10 +101,13 @@ aliases = {
     "成田花崎": "成田花崎（車）",
 }
 
+# 数値に変換しない列
+text_columns = ("地域", "測定局", "種別", "WD 方位")
+
 # apparent nameと内部標準名(そらまめ名)の変換
 converters = {
     # "地域",
-    "測定局": lambda x: STATION(x, aliases=aliases),
+    "測定局": lambda x: STATION(x, aliases=aliases, pref=PREF),
     # "測定局",
     # "種別",
     "SO2 ppm": lambda x: SO2(x, unit="ppm"),
@@ -115,33 +128,41 @@ converters = {
 }
 
 
+@instrument.timed("retrieve_raw", "chiba")
 def retrieve_raw(isotime):
     """指定された日時のデータを入手する。index名とcolumn名は生のまま。"""
     logger = getLogger()
     dt = datetime.datetime.fromisoformat(isotime)
-    date_time = dt.strftime("day=%Y年%m月%d日&hour=%H")
-    if date_time[-2:] == "00":
-        logger.debug(f"Date spec {date_time} is invalid.")
+    day = dt.strftime("%Y年%m月%d日")
+    hour = dt.strftime("%H")
+    if hour == "00":
+        logger.debug(f"Date spec {day} {hour} is invalid.")
         # 00時は存在しないので、前日の24時に書きかえる。
-        date_time = (dt - datetime.timedelta(hours=1)).strftime(
-            "day=%Y年%m月%d日&hour="
-        ) + "24"
-        logger.debug(f"Modified to {date_time}.")
+        day = (dt - datetime.timedelta(hours=1)).strftime("%Y年%m月%d日")
+        hour = "24"
+        logger.debug(f"Modified to {day} {hour}.")
 
-    session = requests_cache.CachedSession("airpollution")
+    session = get_session("chiba")
     response = session.get(
-        f"https://air.taiki.pref.chiba.lg.jp/hourreport/?{date_time}",
+        f"{base_url('chiba', BASE_URL)}/?day={day}&hour={hour}",
+        expire_after=expire_after(isotime),
     )
     # これがないと文字化けする
     response.encoding = response.apparent_encoding
 
     logger.debug(response.text)
-    dfs = pd.read_html(io.StringIO(response.text))
-    return dfs[0]
+    doc = htmltable.parse(response.text)
+    # 間違った日付を与えると今日の最新データが返ってくるので、フォームで確かめる。
+    htmltable.check_form(doc, {"day": day, "hour": hour})
+    return htmltable.table(doc, text_columns=text_columns)
 
 
-def retrieve(isotime, station_set="full"):
-    """指定された日時のデータを入手する。index名とcolumn名をつけなおし、単位をそらまめにあわせる。"""
+@instrument.timed("retrieve", "chiba")
+def retrieve(isotime, station_set="full", compact=False):
+    """指定された日時のデータを入手する。index名とcolumn名をつけなおし、単位をそらまめにあわせる。
+
+    compactにTrueか"scaled"を与えると、convert.compacted()で型を小さくする。
+    """
     logger = getLogger()
 
     df = retrieve_raw(isotime)
@@ -161,7 +182,37 @@ def retrieve(isotime, station_set="full"):
         selection = [type(i) != str and (10000000 <= i <= 99999999) for i in df.index]
         df = df.iloc[selection]
 
-    return df
+    return compacted(df, compact)
+
+
+async def aretrieve(isotime, station_set="full", compact=False):
+    """retrieve()のasyncio版。HOSTへの同時接続数はaioで制限される。"""
+    return await aio.run(
+        HOST, retrieve, isotime, station_set=station_set, compact=compact
+    )
+
+
+def retrieve_range(
+    start,
+    end,
+    station_set="full",
+    max_workers=batch.MAX_WORKERS,
+    compact=False,
+    errors="raise",
+):
+    """startからendまでの毎時のデータを並行して入手し、(time, station)をindexとする1つのDataFrameにまとめる。
+
+    errorsは取得に失敗した時刻の扱い。batch.retrieve_range()を参照。
+    """
+    return batch.retrieve_range(
+        retrieve,
+        start,
+        end,
+        max_workers=max_workers,
+        errors=errors,
+        compact=compact,
+        station_set=station_set,
+    )
 
 
 def test():
@@ -171,17 +222,3 @@ def test():
 if __name__ == "__main__":
     basicConfig(level=DEBUG)
     test()
-
-
-# 千葉のシステムは、間違った日付文字列を与えると(あるいは、それ以外のエラーでも)今日の最新データをしれっと表示するのでとても怖い。
-# 以下の部分をBeautifulSoupあたりでチェックし、日付と時刻がちゃんと選択されていることを確認したほうが良い。
-"""
-<main>
-    <div id="contents">
-        <h1>リアルタイム時報<span>県内の全測定局の全測定物質の1時間値を一覧表で見ることができます。</span></h1>
-        <div id="search">
-            <form method="get" action="./">
-                <input type="text" value="2024年08月31日" name="day" id="day" readonly="readonly">
-                <select name="hour" id="hour">
-                    <option value="01">01</option><option value="02">02</option><option value="03">03</option><option value="04">04</option><option value="05">05</option><option value="06">06</option><option value="07">07</option><option value="08">08</option><option value="09">09</option><option value="10">10</option><option value="11">11</option><option value="12">12</option><option value="13">13</option><option value="14">14</option><option value="15">15</option><option value="16">16</option><option value="17">17</option><option value="18">18</option><option value="19">19</option><option value="20">20</option><option value="21">21</option><option value="22">22</option><option value="23">23</option><option value="24" selected="selected">24</option>                              </select>
-"""
@@ -1,54 +1,64 @@
+from functools import lru_cache
+
+import numpy as np
 import pandas as pd
-from airpollutionwatch.TM20210000 import STATIONS
-import io
-
-# with open("TM20210000.txt") as f:
-#     stations = pd.read_csv(f)
-stations = pd.read_csv(io.StringIO(STATIONS))
-stations = stations[
-    [
-        "測定局名",
-        "８文字名",
-        "国環研局番",
-        "経度_度",
-        "経度_分",
-        "経度_秒",
-        "緯度_度",
-        "緯度_分",
-        "緯度_秒",
-        "標高(m)",
-    ]
-]
-stations["経度"] = (
-    stations["経度_度"] + stations["経度_分"] / 60 + stations["経度_秒"] / 3600
-)
-stations["緯度"] = (
-    stations["緯度_度"] + stations["緯度_分"] / 60 + stations["緯度_秒"] / 3600
-)
-stations = stations[
-    [
-        "測定局名",
-        "８文字名",
-        "国環研局番",
-        "経度",
-        "緯度",
-        "標高(m)",
-    ]
-]
-stations = stations.set_index("国環研局番")
-# print(stations.loc["野田桐ケ作"])
-
-
-def station_to_id(station, aliases=None):
-    if station in aliases:
-        station = aliases[station]
-    match1 = stations["測定局名"] == station
-    match2 = stations["８文字名"] == station
-    rows = stations[match1 | match2]
-    if len(rows) == 1:
-        return int(rows.index[0])
-    # print(station)
-    return station
+from airpollutionwatch import instrument, registry
+
+
+def __getattr__(name):
+    # 測定局一覧は重いので、最初に参照されたときに読みこむ。
+    if name == "stations":
+        return registry.stations()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@lru_cache(maxsize=None)
+def _name_index(pref=None):
+    """測定局名と８文字名から国環研局番を引く辞書。複数の局に該当する名前は含めない。
+
+    prefに都道府県コードを指定すると、その都道府県の局だけで索引を作る。
+    """
+    arrays = registry.load()
+    rows = {}
+    for i, (name, name8) in enumerate(zip(arrays["name"], arrays["name8"])):
+        if pref is not None and arrays["pref"][i] != pref:
+            continue
+        rows.setdefault(name, set()).add(i)
+        rows.setdefault(name8, set()).add(i)
+    codes = arrays["code"]
+    return {name: int(codes[next(iter(i))]) for name, i in rows.items() if len(i) == 1}
+
+
+@lru_cache(maxsize=None)
+def _station_index(aliases: tuple, pref=None):
+    # 都道府県内で一意に決まる名前を優先し、なければ全国で探す。
+    index = dict(_name_index())
+    if pref is not None:
+        index.update(_name_index(pref))
+    lookup = dict(index)
+    for name, alias in aliases:
+        if alias in index:
+            lookup[name] = index[alias]
+        else:
+            # 別名の先が見つからない場合は、別名の先の名前を返す。
+            lookup.pop(name, None)
+    names = pd.Index(list(lookup.keys()))
+    codes = np.array(list(lookup.values()), dtype=np.int64)
+    return lookup, names, codes
+
+
+def station_index(aliases=None, pref=None):
+    """別名を織りこんだ、測定局名から国環研局番への索引を返す。"""
+    key = tuple(sorted(aliases.items())) if aliases else ()
+    return _station_index(key, pref)
+
+
+def station_to_id(station, aliases=None, pref=None):
+    aliases = aliases or {}
+    lookup, _, _ = station_index(aliases, pref)
+    if station in lookup:
+        return lookup[station]
+    return aliases.get(station, station)
 
 
 # converters
@@ -123,8 +133,19 @@ def PERCENT(series: pd.Series, unit: str = "%"):
     return series
 
 
-def STATION(series: pd.Series, aliases: dict):
-    return series.apply(lambda x: station_to_id(x, aliases)).rename("station")
+@instrument.timed("convert")
+def STATION(series: pd.Series, aliases: dict, pref: int = None):
+    aliases = aliases or {}
+    _, names, codes = station_index(aliases, pref)
+    pos = names.get_indexer(series)
+    found = pos >= 0
+    if found.all():
+        return pd.Series(codes[pos], index=series.index, name="station")
+    # 見つからない局は名前のまま残す。
+    values = np.empty(len(series), dtype=object)
+    values[found] = codes[pos[found]].tolist()
+    values[~found] = [aliases.get(x, x) for x in series.to_numpy()[~found]]
+    return pd.Series(values, index=series.index, name="station")
 
 
 wd_codes_EN = {
@@ -157,85 +178,166 @@ wd_codes_EN = {
 def DIRC16(series: pd.Series, unit: str = "16dirc"):
     if unit == "EN":
         # 英文字表示を気象庁の16方位数に換算する。
-        return series.apply(lambda x: wd_codes_EN.get(x, 0)).astype("Int64")
+        return series.map(wd_codes_EN).fillna(0).astype("Int8")
     assert unit == "16dirc", f"unknown unit {unit}"
-    return series.apply(lambda x: pd.to_numeric(x, errors="coerce")).astype("Int64")
+    series = pd.to_numeric(series, errors="coerce")
+    # 999などの欠測の印や範囲外の値は欠測にする。そのままではInt8にできない。
+    valid = series.between(0, 17) & (series % 1 == 0)
+    return series.where(valid).astype("Int8")
 
 
+@instrument.timed("convert")
 def SO2(series: pd.Series, unit: str = "ppb"):
     return PPB(series, unit).rename("SO2")
 
 
+@instrument.timed("convert")
 def NO(series: pd.Series, unit: str = "ppb"):
     return PPB(series, unit).rename("NO")
 
 
+@instrument.timed("convert")
 def NO2(series: pd.Series, unit: str = "ppb"):
     return PPB(series, unit).rename("NO2")
 
 
+@instrument.timed("convert")
 def NOX(series: pd.Series, unit: str = "ppb"):
     return PPB(series, unit).rename("NOX")
 
 
+@instrument.timed("convert")
 def OX(series: pd.Series, unit: str = "ppb"):
     return PPB(series, unit).rename("OX")
 
 
+@instrument.timed("convert")
 def CO(series: pd.Series, unit: str = "0.1ppm"):
     return dPPM(series, unit).rename("CO")
 
 
+@instrument.timed("convert")
 def NMHC(series: pd.Series, unit: str = "10ppbC"):
     return DPPBC(series, unit).rename("NMHC")
 
 
+@instrument.timed("convert")
 def CH4(series: pd.Series, unit: str = "10ppbC"):
     return DPPBC(series, unit).rename("CH4")
 
 
+@instrument.timed("convert")
 def THC(series: pd.Series, unit: str = "10ppbC"):
     return DPPBC(series, unit).rename("THC")
 
 
+@instrument.timed("convert")
 def WD(series: pd.Series, unit: str = "16dirc"):
     return DIRC16(series, unit).rename("WD")
 
 
+@instrument.timed("convert")
 def WS(series: pd.Series, unit: str = "0.1m/s"):
     return dM_S(series, unit).rename("WS")
 
 
+@instrument.timed("convert")
 def TEMP(series: pd.Series, unit: str = "celsius"):
     return CELSIUS(series, unit).rename("TEMP")
 
 
+@instrument.timed("convert")
 def HUM(series: pd.Series, unit: str = "%"):
     return PERCENT(series, unit).rename("HUM")
 
 
+@instrument.timed("convert")
 def SPM(series: pd.Series, unit: str = "ug/m3"):
     return UG_M3(series, unit).rename("SPM")
 
 
+@instrument.timed("convert")
 def PM25(series: pd.Series, unit: str = "ug/m3"):
     return UG_M3(series, unit).rename("PM25")
 
 
+@instrument.timed("convert")
 def LON(series: pd.Series, unit: str = "degree"):
     return DEGREE(series, unit).rename("lon")
 
 
+@instrument.timed("convert")
 def LAT(series: pd.Series, unit: str = "degree"):
     return DEGREE(series, unit).rename("lat")
 
 
+@instrument.timed("convert")
 def CODE(series: pd.Series):
     return NOP(series).rename("code")
 
 
+# 0.1m/s, 0.1℃, 0.1ppm, 10ppbC単位の量。そらまめの分解能では整数になる。
+SCALED = ("WS", "TEMP", "CO", "NMHC", "CH4", "THC")
+
+
+def _compact_index(index):
+    if isinstance(index, pd.MultiIndex):
+        # 水準はすでに重複なしなので、整数の幅だけ詰める。
+        return index.set_levels(
+            [
+                _compact_index(level) if level.dtype == "int64" else level
+                for level in index.levels
+            ]
+        )
+    if index.dtype == "int64":
+        info = np.iinfo(np.int32)
+        if len(index) == 0 or (info.min <= index.min() and index.max() <= info.max):
+            return index.astype("int32")
+        return index
+    if index.dtype == object:
+        # 名前のまま残った局が混じっている。
+        return pd.CategoricalIndex(index, name=index.name)
+    return index
+
+
+def compact(df: pd.DataFrame, scale: bool = False):
+    """変換済みのDataFrameの型を小さくする。
+
+    実数の列はfloat32に、WDはInt8に、文字列の列はcategoryにする。
+    scale=Trueなら、SCALEDの列は整数に丸めてInt16にする(単位はそのまま)。
+    局番のindexは、すべて整数ならint32に、名前のまま残った局があればcategoryにする。
+    """
+    dtypes = {}
+    for name, dtype in df.dtypes.items():
+        if name == "WD":
+            dtypes[name] = "Int8"
+        elif scale and name in SCALED:
+            dtypes[name] = "Int16"
+        elif dtype == "float64":
+            dtypes[name] = "float32"
+        elif dtype == object:
+            dtypes[name] = "category"
+    scaled = [name for name, dtype in dtypes.items() if dtype == "Int16"]
+    if scaled:
+        df = df.assign(**{name: df[name].round() for name in scaled})
+    df = df.astype(dtypes)
+    df.index = _compact_index(df.index)
+    return df
+
+
+def compacted(df: pd.DataFrame, mode=False):
+    """retrieve()のcompact引数にあわせてcompact()する。
+
+    Falseならそのまま、Trueならcompact(df)、"scaled"ならcompact(df, scale=True)。
+    """
+    if not mode:
+        return df
+    assert mode in (True, "scaled"), f"unknown compact mode {mode}"
+    return compact(df, scale=mode == "scaled")
+
+
 def test():
-    print(stations.head())
+    print(registry.stations().head())
 
 
 if __name__ == "__main__":
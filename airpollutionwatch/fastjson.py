@@ -0,0 +1,21 @@
+"""JSONをresponse.contentのバイト列から直接デコードする。
+
+orjsonが入っていればそれを使い、なければ標準のjsonを使う。
+response.textへのデコードやStringIOを経由しないので、余計なコピーが減る。
+"""
+
+import pandas as pd
+
+try:
+    import orjson
+
+    loads = orjson.loads
+except ImportError:
+    import json
+
+    loads = json.loads
+
+
+def records(content):
+    """{key: {field: value}}の形のJSONを、keyをindexとするDataFrameにする。"""
+    return pd.DataFrame.from_dict(loads(content), orient="index")
@@ -0,0 +1,57 @@
+"""応答が前回と変わっていなければ、解析と変換を省いて前回のDataFrameを返す。
+
+最新の時間を数分おきに取りにいくとき、条件付きGET(If-None-Match/If-Modified-Since)は
+requests_cacheがする(session.expire_after()を参照)。304が返ると、キャッシュにある応答が返ってくる。
+応答の目印は、ETagかLast-Modifiedがあればそれ、なければ本文のハッシュ。
+ETagなどを返さないサーバでも、本文が同じなら解析しなおさない。
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+
+from airpollutionwatch import memo
+
+# 覚えておくDataFrameの数
+MAXSIZE = 64
+
+_frames = OrderedDict()
+_lock = threading.Lock()
+
+
+def fingerprint(response):
+    """応答の目印。"""
+    etag = response.headers.get("ETag")
+    modified = response.headers.get("Last-Modified")
+    if etag or modified:
+        return ("validator", response.url, etag, modified)
+    return ("sha1", hashlib.sha1(response.content).hexdigest())
+
+
+def lookup(key, *responses):
+    """keyについて覚えているDataFrameが、responsesから作ったものならそのコピーを返す。
+
+    (目印, DataFrameかNone)を返す。目印はstore()に渡す。
+    """
+    mark = tuple(fingerprint(response) for response in responses)
+    with _lock:
+        hit = _frames.get(key)
+        if hit is not None and hit[0] == mark:
+            _frames.move_to_end(key)
+            return mark, hit[1].copy()
+    return mark, None
+
+
+def store(key, mark, df):
+    """目印markの応答から作ったDataFrameを覚えておく。"""
+    with _lock:
+        _frames[key] = (mark, df.copy())
+        _frames.move_to_end(key)
+        while len(_frames) > MAXSIZE:
+            _frames.popitem(last=False)
+
+
+@memo.on_refresh
+def clear():
+    with _lock:
+        _frames.clear()
@@ -0,0 +1,126 @@
+"""HTMLのページから、必要な表とフォームの値だけをlxmlで取りだす。
+
+pd.read_htmlはページ中のすべての表を解析して型を推定するので遅い。
+ここでは1つの表だけを読み、列名はread_htmlと同じ規則で作る。
+"""
+
+import re
+
+import lxml.html
+import pandas as pd
+
+# read_htmlと同じく、改行と2文字以上の空白を1つの空白にまとめる。
+_WHITESPACE = re.compile(r"[\r\n]+|\s{2,}")
+
+
+def parse(text):
+    """HTMLの文字列を解析する。<br>は改行として扱い、表示されない要素は取りのぞく。"""
+    doc = lxml.html.fromstring(text)
+    for br in doc.iter("br"):
+        br.tail = "\n" + (br.tail or "")
+    for element in doc.xpath(
+        "//*[contains(translate(@style, ' ', ''), 'display:none')]"
+    ):
+        element.drop_tree()
+    return doc
+
+
+def _text(cell):
+    return _WHITESPACE.sub(" ", cell.text_content().strip())
+
+
+def _rows(trs):
+    """trのリストを、colspanとrowspanを展開した文字列のリストのリストにする。"""
+    rows = []
+    # 上の行からrowspanで降りてくるセル。(列番号, 文字列, 残りの行数)
+    remainder = []
+    for tr in trs:
+        row = []
+        spanning = []
+        index = 0
+        for cell in tr.xpath("./td|./th"):
+            while remainder and remainder[0][0] <= index:
+                _, text, left = remainder.pop(0)
+                row.append(text)
+                if left > 1:
+                    spanning.append((len(row) - 1, text, left - 1))
+                index += 1
+            text = _text(cell)
+            rowspan = int(cell.get("rowspan", 1) or 1)
+            for _ in range(int(cell.get("colspan", 1) or 1)):
+                row.append(text)
+                if rowspan > 1:
+                    spanning.append((len(row) - 1, text, rowspan - 1))
+                index += 1
+        for _, text, left in remainder:
+            row.append(text)
+            if left > 1:
+                spanning.append((len(row) - 1, text, left - 1))
+        remainder = spanning
+        rows.append(row)
+    return rows
+
+
+def table(doc, index=0, text_columns=()):
+    """index番目の表をDataFrameにする。
+
+    列名はthead(なければ先頭の<th>だけの行)から作る。
+    text_columnsに挙げた列は文字列のまま、それ以外の列は数値に変換する。
+    """
+    element = doc.xpath("//table")[index]
+    header = element.xpath("./thead/tr")
+    body = element.xpath("./tbody/tr|./tr")
+    if not header:
+        while body and not body[0].xpath("./td"):
+            header.append(body.pop(0))
+    columns = _rows(header)[0] if header else None
+    rows = _rows(body)
+    width = len(columns) if columns else max(map(len, rows), default=0)
+    # 短い行は空欄で埋め、長い行は切りつめる。
+    rows = [(row + [""] * width)[:width] for row in rows]
+    df = pd.DataFrame(rows, columns=columns)
+    for col in df.columns:
+        if col in text_columns:
+            df[col] = df[col].replace("", None)
+        else:
+            df[col] = pd.to_numeric(df[col], errors="coerce")
+    return df
+
+
+def form_value(doc, name):
+    """フォームのnameという項目に入っている値。inputのvalueか、selectの選択肢。"""
+    for element in doc.xpath(f"//input[@name='{name}']"):
+        return element.get("value")
+    for element in doc.xpath(f"//select[@name='{name}']"):
+        for option in element.xpath(".//option[@selected]"):
+            return option.get("value", option.text_content())
+    return None
+
+
+def _numbers(text):
+    return [int(x) for x in re.findall(r"\d+", str(text))]
+
+
+def _same_numbers(actual, value):
+    # 数の区切りが同じなら、数ごとに整数で比べる("2"と"02"、"0"と"00"は一致)。
+    a, b = _numbers(actual), _numbers(value)
+    if len(a) == len(b):
+        return a == b
+    # "2024年08月31日"と"20240831"のように区切りが違えば、数字をつないで比べる。
+    digits = [re.sub(r"\D", "", str(x)).lstrip("0") for x in (actual, value)]
+    return digits[0] == digits[1]
+
+
+def check_form(doc, expected):
+    """フォームに選択されている値が、要求したものと一致することを確かめる。
+
+    expectedはフォームの項目名と値の辞書。項目ごとに数だけを整数として比べるので、
+    "2"と"02"、"2024年08月31日"と"20240831"は一致するとみなす。
+    ページにその項目がない場合は確かめない。
+    """
+    for name, value in expected.items():
+        actual = form_value(doc, name)
+        if actual is None:
+            continue
+        if not _same_numbers(actual, value):
+            raise ValueError(f"The page shows {name}={actual}, not {value}.")
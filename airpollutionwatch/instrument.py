@@ -0,0 +1,303 @@
+"""取得と変換の計測。sinkを登録したときだけ働く。
+
+    from airpollutionwatch import instrument
+    counters = instrument.Counters()
+    instrument.add_sink(counters)
+    ...
+    print(counters.frame())
+
+retrieve_raw(), retrieve(), stations()/items()と単位の変換関数を呼ぶたびに、
+次のような辞書(イベント)を登録されたすべてのsinkに渡す。
+    source      取得元の名前(変換関数では、それを呼んだ取得元)
+    stage       retrieve_raw, retrieve, stations, items, convert, http
+    name        関数名(変換関数ではSO2など)
+    seconds     所要時間
+    requests    呼び出しの間のHTTP要求の数
+    bytes       受けとった本文のバイト数
+    cache_hits  requests_cacheのキャッシュから返った要求の数
+    rows        結果の行数
+    unresolved  国環研局番に変換できなかった測定局の数
+    error       例外が出たらそのrepr、出なければNone
+HTTPの応答ごとにもstage="http"のイベント(url, status, bytes, from_cache)を出す。
+共有セッションには応答のフックが入っている。自前のセッションを使うときはattach()する。
+"""
+
+import functools
+import os
+import threading
+import time
+from collections import defaultdict
+from logging import getLogger, INFO
+
+import pandas as pd
+
+# イベントを受けとる関数のリスト
+sinks = []
+
+_local = threading.local()
+
+
+def add_sink(sink):
+    """イベントを受けとる関数(1引数)を登録する。"""
+    sinks.append(sink)
+    return sink
+
+
+def remove_sink(sink):
+    sinks.remove(sink)
+
+
+def emit(event):
+    for sink in list(sinks):
+        try:
+            sink(event)
+        except Exception as e:
+            getLogger().warning(f"instrument sink failed: {e!r}")
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+def on_response(response, *args, **kwargs):
+    """セッションの応答フック。呼び出し中の計測にバイト数とキャッシュの当否を足す。"""
+    # requests_cacheは、ネットワークから取った応答ではフックを2回呼ぶ。
+    if not sinks or getattr(response, "_instrumented", False):
+        return response
+    response._instrumented = True
+    size = len(response.content)
+    from_cache = bool(getattr(response, "from_cache", False))
+    stack = _stack()
+    for frame in stack:
+        frame["requests"] += 1
+        frame["bytes"] += size
+        frame["cache_hits"] += from_cache
+    emit(
+        {
+            "source": stack[-1]["source"] if stack else None,
+            "stage": "http",
+            "name": response.request.method,
+            "url": response.url,
+            "status": response.status_code,
+            "bytes": size,
+            "from_cache": from_cache,
+        }
+    )
+    return response
+
+
+def attach(session):
+    """sessionの応答を計測に入れる。"""
+    if on_response not in session.hooks["response"]:
+        session.hooks["response"].append(on_response)
+    return session
+
+
+# 局番の解決が済んでいる段階
+UNRESOLVED = ("retrieve", "convert")
+
+
+def _unresolved(result):
+    """局番が文字列のまま残った測定局の数。"""
+    if isinstance(result, pd.DataFrame):
+        keys = result.index
+    elif isinstance(result, pd.Series) and result.name == "station":
+        keys = result
+    else:
+        return None
+    if keys.dtype != object:
+        return 0
+    return sum(isinstance(key, str) for key in keys)
+
+
+def _rows(result):
+    """結果の行数。いくつかの値の組を返す関数ではNone。"""
+    if isinstance(result, tuple) or not hasattr(result, "__len__"):
+        return None
+    return len(result)
+
+
+def _call(source, stage, func, args, kwargs):
+    stack = _stack()
+    if source is None and stack:
+        source = stack[-1]["source"]
+    frame = {"source": source, "requests": 0, "bytes": 0, "cache_hits": 0}
+    stack.append(frame)
+    error = None
+    result = None
+    t0 = time.perf_counter()
+    try:
+        result = func(*args, **kwargs)
+        return result
+    except Exception as e:
+        error = repr(e)
+        raise
+    finally:
+        seconds = time.perf_counter() - t0
+        stack.pop()
+        emit(
+            dict(
+                frame,
+                stage=stage,
+                name=func.__name__,
+                seconds=seconds,
+                rows=_rows(result),
+                unresolved=_unresolved(result) if stage in UNRESOLVED else None,
+                error=error,
+            )
+        )
+
+
+def timed(stage, source=None):
+    """関数の呼び出しを計測するデコレータ。sinkがなければそのまま呼ぶ。
+
+    sourceを省くと、呼び出し中の取得元の名前を使う。
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not sinks:
+                return func(*args, **kwargs)
+            return _call(source, stage, func, args, kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def method(stage):
+    """timed()のメソッド版。インスタンスのname属性を取得元の名前にする。"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not sinks:
+                return func(self, *args, **kwargs)
+            return _call(self.name, stage, func, (self,) + args, kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+class LogSink:
+    """イベントをloggingに書く。"""
+
+    def __init__(self, logger=None, level=INFO):
+        self.logger = logger or getLogger("airpollutionwatch.instrument")
+        self.level = level
+
+    def __call__(self, event):
+        if event["stage"] == "http":
+            message = (
+                f"{event['source']} http {event['status']} {event['url']} "
+                f"{event['bytes']}B {'cached' if event['from_cache'] else 'fetched'}"
+            )
+        else:
+            message = (
+                f"{event['source']} {event['stage']} {event['name']} "
+                f"{event['seconds'] * 1000:.1f}ms {event['bytes']}B "
+                f"cache {event['cache_hits']}/{event['requests']} "
+                f"rows {event['rows']} unresolved {event['unresolved']}"
+            )
+            if event["error"]:
+                message += f" error {event['error']}"
+        self.logger.log(self.level, message)
+
+
+# Countersが積算する量
+FIELDS = [
+    "calls",
+    "errors",
+    "seconds",
+    "requests",
+    "bytes",
+    "cache_hits",
+    "cache_misses",
+    "rows",
+    "unresolved",
+]
+
+
+class Counters:
+    """イベントを(取得元, 段階, 関数名)ごとに積算する。"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = defaultdict(lambda: dict.fromkeys(FIELDS, 0))
+
+    def __call__(self, event):
+        if event["stage"] == "http":
+            requests, hits = 1, int(event["from_cache"])
+        else:
+            requests, hits = event["requests"], event["cache_hits"]
+        with self.lock:
+            count = self.counts[event["source"], event["stage"], event["name"]]
+            count["calls"] += 1
+            count["errors"] += bool(event.get("error"))
+            count["seconds"] += event.get("seconds") or 0.0
+            count["requests"] += requests
+            count["bytes"] += event["bytes"]
+            count["cache_hits"] += hits
+            count["cache_misses"] += requests - hits
+            count["rows"] += event.get("rows") or 0
+            count["unresolved"] += event.get("unresolved") or 0
+
+    def reset(self):
+        with self.lock:
+            self.counts.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {key: dict(value) for key, value in self.counts.items()}
+
+    def frame(self):
+        """(source, stage, name)をindexとするDataFrame。"""
+        df = pd.DataFrame.from_dict(self.snapshot(), orient="index", columns=FIELDS)
+        df.index.names = ["source", "stage", "name"]
+        return df
+
+
+class PrometheusTextfile(Counters):
+    """積算した値を、node_exporterのtextfile collector形式でpathに書く。
+
+    interval秒に1回だけ書きなおす。最後の値を確実に書くにはwrite()を呼ぶ。
+    """
+
+    def __init__(self, path, interval=15.0, prefix="airpollutionwatch"):
+        super().__init__()
+        self.path = path
+        self.interval = interval
+        self.prefix = prefix
+        self.written = 0.0
+        self.write_lock = threading.Lock()
+
+    def __call__(self, event):
+        super().__call__(event)
+        if time.monotonic() - self.written >= self.interval:
+            self.write()
+
+    def text(self):
+        snapshot = self.snapshot()
+        lines = []
+        for field in FIELDS:
+            metric = f"{self.prefix}_{field}_total"
+            lines.append(f"# TYPE {metric} counter")
+            for (source, stage, name), count in sorted(
+                snapshot.items(), key=lambda x: tuple(map(str, x[0]))
+            ):
+                labels = f'source="{source or ""}",stage="{stage}",name="{name}"'
+                lines.append(f"{metric}{{{labels}}} {count[field]}")
+        return "\n".join(lines) + "\n"
+
+    def write(self):
+        with self.write_lock:
+            self.written = time.monotonic()
+            # collectorが書きかけのファイルを読まないように、置きかえで書く。
+            with open(self.path + ".tmp", "w") as f:
+                f.write(self.text())
+            os.replace(self.path + ".tmp", self.path)
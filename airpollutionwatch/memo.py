@@ -0,0 +1,60 @@
+"""プロセス内で使いまわす、有効期限つきのメモ化。
+
+測定局や測定項目の対応表のように、めったに変わらないのに毎時間の取得で
+必要になるものを、HTTPキャッシュやJSONの解析を通さずに使いまわす。
+"""
+
+import functools
+import threading
+import time
+
+# 測定局・測定項目の対応表の有効期限(秒)
+METADATA_TTL = 3600
+
+_clears = []
+
+
+def ttl_cache(seconds):
+    """関数の戻り値を引数ごとにseconds秒だけ覚えておくデコレータ。
+
+    デコレートされた関数はcache_clear()で個別に忘れさせることができる。
+    """
+
+    def decorator(func):
+        store = {}
+        lock = threading.Lock()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = (args, tuple(sorted(kwargs.items())))
+            now = time.monotonic()
+            with lock:
+                hit = store.get(key)
+            if hit is not None and now - hit[0] < seconds:
+                return hit[1]
+            value = func(*args, **kwargs)
+            with lock:
+                store[key] = (now, value)
+            return value
+
+        def cache_clear():
+            with lock:
+                store.clear()
+
+        wrapper.cache_clear = cache_clear
+        _clears.append(cache_clear)
+        return wrapper
+
+    return decorator
+
+
+def on_refresh(cache_clear):
+    """refresh()のときに呼ぶ関数を登録する。"""
+    _clears.append(cache_clear)
+    return cache_clear
+
+
+def refresh():
+    """すべてのメモを捨てる。次の呼び出しで取りなおされる。"""
+    for cache_clear in _clears:
+        cache_clear()
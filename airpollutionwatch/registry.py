@@ -0,0 +1,88 @@
+"""国環研の測定局一覧(TM20210000)を、コンパクトなバイナリにして遅延読み込みする。
+
+TM20210000.pyのCSV文字列を毎回read_csvすると重いので、必要な列だけを
+stations.npzに書きだしておき、最初に使われたときに読みこむ。
+TM20210000.pyを更新したら、`python -m airpollutionwatch.registry`で再生成する。
+"""
+
+import io
+import os
+from functools import lru_cache
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+ARTIFACT = os.path.join(os.path.dirname(__file__), "stations.npz")
+
+# npzに保存する列名と、TM20210000の列名との対応
+COLUMNS = {
+    "code": "国環研局番",
+    "name": "測定局名",
+    "name8": "８文字名",
+    "pref": "都道府県コード",
+    "alt": "標高(m)",
+}
+
+
+def build(path=ARTIFACT):
+    """TM20210000.pyのCSVを解析して、必要な列だけをnpzに保存する。"""
+    from airpollutionwatch.TM20210000 import STATIONS
+
+    df = pd.read_csv(
+        io.StringIO(STATIONS),
+        usecols=list(COLUMNS.values())
+        + ["経度_度", "経度_分", "経度_秒", "緯度_度", "緯度_分", "緯度_秒"],
+    )
+    arrays = {key: df[col].to_numpy() for key, col in COLUMNS.items()}
+    arrays["name"] = arrays["name"].astype(str)
+    arrays["name8"] = arrays["name8"].astype(str)
+    arrays["pref"] = arrays["pref"].astype(np.int16)
+    # 度分秒を度に変換
+    arrays["lon"] = (
+        df["経度_度"] + df["経度_分"] / 60 + df["経度_秒"] / 3600
+    ).to_numpy()
+    arrays["lat"] = (
+        df["緯度_度"] + df["緯度_分"] / 60 + df["緯度_秒"] / 3600
+    ).to_numpy()
+    if path is not None:
+        np.savez_compressed(path, **arrays)
+    return arrays
+
+
+@lru_cache(maxsize=None)
+def load(path=ARTIFACT):
+    """npzから測定局一覧の配列を読みこむ。なければその場で作る。"""
+    logger = getLogger()
+    try:
+        with np.load(path, allow_pickle=False) as npz:
+            return {key: npz[key] for key in npz.files}
+    except FileNotFoundError:
+        logger.info(f"{path} not found. Building from TM20210000.")
+    try:
+        return build(path)
+    except OSError:
+        # パッケージのディレクトリに書けない場合はメモリ上だけで使う。
+        return build(None)
+
+
+@lru_cache(maxsize=None)
+def stations():
+    """国環研局番をindexとする測定局のDataFrame。"""
+    arrays = load()
+    df = pd.DataFrame(
+        {
+            "測定局名": arrays["name"],
+            "８文字名": arrays["name8"],
+            "国環研局番": arrays["code"],
+            "経度": arrays["lon"],
+            "緯度": arrays["lat"],
+            "標高(m)": arrays["alt"],
+        }
+    )
+    return df.set_index("国環研局番")
+
+
+if __name__ == "__main__":
+    build()
+    print(f"{ARTIFACT} is updated.")
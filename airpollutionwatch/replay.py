@@ -0,0 +1,268 @@
+"""実際の応答を記録し、ローカルのスタンドインサーバで再生する。
+
+ネットワークから切りはなされたCIでベンチマークや負荷試験をするためのもの。
+
+記録する:
+    python -m airpollutionwatch.replay record fixtures 2024-09-01T01:00+09:00 ...
+再生する:
+    python -m airpollutionwatch.replay serve fixtures --port 8000 --latency 0.2 --error-rate 0.05
+
+スタンドインサーバは http://host:port/<取得元>/<元のURLのベースより後ろ> で応答する。
+StandIn.override()を呼ぶか、環境変数AIRPOLLUTIONWATCH_<NAME>_URLを設定すると、
+各モジュールはスタンドインサーバからデータを取得する。
+"""
+
+import argparse
+import hashlib
+import importlib
+import json
+import os
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from logging import getLogger, basicConfig, INFO
+
+from airpollutionwatch import session
+
+# 記録・再生する取得元のモジュール
+SOURCES = ["tokyo", "kanagawa", "chiba", "yamanashi", "shizuoka", "amedas"]
+
+
+def _module(name):
+    return importlib.import_module(f"airpollutionwatch.{name}")
+
+
+def _key(method, url, body):
+    if isinstance(body, str):
+        body = body.encode()
+    digest = hashlib.sha1()
+    for part in (method.upper().encode(), url.encode(), body or b""):
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def save(directory, method, url, body, status, content_type, content):
+    """応答を1つfixtureとして保存する。"""
+    os.makedirs(directory, exist_ok=True)
+    key = _key(method, url, body)
+    if isinstance(body, bytes):
+        body = body.decode()
+    meta = {
+        "method": method,
+        "url": url,
+        "body": body,
+        "status": status,
+        "content_type": content_type,
+    }
+    # 並行して取得すると同じ応答が同時に保存されることがあるので、置きかえで書く。
+    suffix = f".{os.getpid()}.{threading.get_ident()}.tmp"
+    path = os.path.join(directory, key)
+    with open(path + ".bin" + suffix, "wb") as f:
+        f.write(content)
+    os.replace(path + ".bin" + suffix, path + ".bin")
+    with open(path + ".json" + suffix, "w") as f:
+        json.dump(meta, f, ensure_ascii=False, indent=1)
+    os.replace(path + ".json" + suffix, path + ".json")
+
+
+def record(directory, target=None):
+    """共有セッション(またはtarget)がネットワークから受けとった応答をdirectoryに保存する。
+
+    記録をやめるための関数を返す。
+    """
+    target = target or session.get_session()
+
+    def hook(response, *args, **kwargs):
+        # フックはrequests_cacheのキャッシュから返った応答でも呼ばれるので、それは除く。
+        if getattr(response, "from_cache", False):
+            return response
+        request = response.request
+        save(
+            directory,
+            request.method,
+            request.url,
+            request.body,
+            response.status_code,
+            response.headers.get("Content-Type", ""),
+            response.content,
+        )
+        return response
+
+    target.hooks["response"].append(hook)
+    return lambda: target.hooks["response"].remove(hook)
+
+
+class StandIn:
+    """記録した応答を返すローカルHTTPサーバ。
+
+    latency秒(とjitter秒までの揺らぎ)だけ待ってから応答し、
+    error_rateの確率でerror_statusを返す。記録のないURLには404を返す。
+    etag=Trueなら本文のハッシュをETagにつけ、If-None-Matchが一致すれば304を返す。
+    """
+
+    def __init__(
+        self,
+        directory,
+        host="127.0.0.1",
+        port=0,
+        latency=0.0,
+        jitter=0.0,
+        error_rate=0.0,
+        error_status=503,
+        seed=None,
+        etag=True,
+    ):
+        self.directory = directory
+        self.etag = etag
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.defaults = {name: _module(name).BASE_URL for name in SOURCES}
+        self.server = ThreadingHTTPServer((host, port), self._handler())
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def original_url(self, path):
+        """スタンドインサーバのパスを、記録したときのURLに戻す。"""
+        name, _, rest = path.lstrip("/").partition("/")
+        if name not in self.defaults:
+            return None
+        return f"{self.defaults[name]}/{rest}"
+
+    def lookup(self, method, path, body):
+        url = self.original_url(path)
+        if url is None:
+            return None
+        key = _key(method, url, body)
+        try:
+            with open(os.path.join(self.directory, f"{key}.json")) as f:
+                meta = json.load(f)
+            with open(os.path.join(self.directory, f"{key}.bin"), "rb") as f:
+                return meta, f.read()
+        except FileNotFoundError:
+            return None
+
+    def _handler(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _reply(self, method):
+                length = int(self.headers.get("Content-Length", 0) or 0)
+                body = self.rfile.read(length) if length else None
+                time.sleep(standin.latency + standin.random.uniform(0, standin.jitter))
+                if standin.random.random() < standin.error_rate:
+                    self.send_error(standin.error_status)
+                    return
+                found = standin.lookup(method, self.path, body)
+                if found is None:
+                    self.send_error(404)
+                    return
+                meta, content = found
+                if standin.etag:
+                    etag = '"' + hashlib.sha1(content).hexdigest() + '"'
+                    if self.headers.get("If-None-Match") == etag:
+                        self.send_response(304)
+                        self.send_header("ETag", etag)
+                        self.end_headers()
+                        return
+                self.send_response(meta["status"])
+                if standin.etag:
+                    self.send_header("ETag", etag)
+                self.send_header("Content-Type", meta["content_type"])
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self._reply("GET")
+
+            def do_POST(self):
+                self._reply("POST")
+
+            def log_message(self, format, *args):
+                getLogger().debug(format % args)
+
+        return Handler
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.restore()
+
+    def override(self):
+        """すべての取得元のベースURLをこのサーバに向ける。"""
+        for name in SOURCES:
+            session.override_base_url(name, f"{self.url}/{name}")
+
+    def restore(self):
+        for name in SOURCES:
+            session.override_base_url(name, None)
+
+    def __enter__(self):
+        self.start()
+        self.override()
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="record/replay HTTP fixtures")
+    commands = parser.add_subparsers(dest="command", required=True)
+    rec = commands.add_parser("record")
+    rec.add_argument("directory")
+    rec.add_argument("isotimes", nargs="+")
+    rec.add_argument("--sources", nargs="*", default=SOURCES)
+    serve = commands.add_parser("serve")
+    serve.add_argument("directory")
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8000)
+    serve.add_argument("--latency", type=float, default=0.0)
+    serve.add_argument("--jitter", type=float, default=0.0)
+    serve.add_argument("--error-rate", type=float, default=0.0)
+    serve.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+
+    basicConfig(level=INFO)
+    logger = getLogger()
+    if args.command == "record":
+        # キャッシュから返った応答は記録されないので、空のキャッシュで取得する。
+        session.set_session(session.new_session(backend="memory"))
+        stop = record(args.directory)
+        for name in args.sources:
+            for isotime in args.isotimes:
+                try:
+                    _module(name).retrieve(isotime)
+                except Exception as e:
+                    logger.warning(f"{name} {isotime}: {e!r}")
+        stop()
+    else:
+        standin = StandIn(
+            args.directory,
+            host=args.host,
+            port=args.port,
+            latency=args.latency,
+            jitter=args.jitter,
+            error_rate=args.error_rate,
+            error_status=args.error_status,
+        )
+        logger.info(f"serving {args.directory} at {standin.url}")
+        standin.server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
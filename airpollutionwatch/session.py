@@ -0,0 +1,300 @@
+"""すべての取得元で共有するHTTPセッション。
+
+取得のたびにCachedSessionを作ると、キャッシュのDBへの接続もTCP/TLSの接続も
+使いまわせないので、プロセスで1つのセッションを共有する。
+設定を変えたいときはconfigure()、自前のセッションを使いたいときはset_session()を呼ぶ。
+キャッシュの置き場所と保存形式はcachestoreを参照。
+
+毎時のデータは、まだ更新される時間は短い期限で、確定した時間は無期限にキャッシュする。
+キャッシュが大きくなりすぎたら、compact_cache()で期限切れと古い応答を消す。
+    python -m airpollutionwatch.session --max-mb 500
+取得元ごとのキャッシュ(settings["shard"])も縮めるには--shardをつける。
+"""
+
+import argparse
+import datetime
+import os
+import threading
+
+import requests
+import requests_cache
+from requests_cache.backends.filesystem import FileDict
+
+from airpollutionwatch import cachestore, instrument
+
+# 毎時のデータのキャッシュの有効期限(秒)。
+# 最新の時間のデータは、まだ測定局のデータがそろっていないことがある。
+# 0なら毎回条件付きGET(ETag/Last-Modified)で確かめる。これらを返さないサーバではキャッシュしない。
+CURRENT_TTL = requests_cache.EXPIRE_IMMEDIATELY
+# 当日のデータは、速報値が差しかえられることがある。
+RECENT_TTL = 3600
+# これより古い時間のデータは確定とみなして、無期限にキャッシュする。
+FINAL_AFTER = datetime.timedelta(days=1)
+
+# HTTPの(接続, 読みだし)のタイムアウト(秒)。止まったサーバでスレッドが残りつづけないように。
+TIMEOUT = (10, 60)
+
+# 測定局一覧などのメタデータのキャッシュの有効期限(秒)
+METADATA_EXPIRE = 86400
+
+# URLのパターンごとの有効期限。毎時のデータは要求ごとにexpire_after()で決める。
+urls_expire_after = {
+    "*/V501Station.json": METADATA_EXPIRE,
+    "*/V502Item.json": METADATA_EXPIRE,
+    "*/amedastable.json": METADATA_EXPIRE,
+}
+
+# new_session()の既定値
+settings = {
+    "cache_name": "airpollution",
+    "backend": "sqlite",
+    "cache_dir": None,
+    "pool_connections": 10,
+    "pool_maxsize": 10,
+    "keep_alive": True,
+    "timeout": TIMEOUT,
+    # Trueなら、取得元ごとに別のキャッシュ(cache_name-取得元)を使う。
+    "shard": False,
+}
+
+# 取得元ごとのベースURLの上書き。replayのスタンドインサーバに向けるときなどに使う。
+base_urls = {}
+
+_session = None
+_shards = {}
+# set_session()されたら、shardの設定によらずそのセッションだけを使う。
+_fixed = False
+_lock = threading.Lock()
+
+
+def base_url(name, default):
+    """取得元nameのベースURL。
+
+    override_base_url()か、環境変数AIRPOLLUTIONWATCH_<NAME>_URLで上書きできる。
+    """
+    return (
+        base_urls.get(name)
+        or os.environ.get(f"AIRPOLLUTIONWATCH_{name.upper()}_URL")
+        or default
+    )
+
+
+def override_base_url(name, url):
+    """取得元nameのベースURLをurlにする。Noneなら元に戻す。"""
+    if url is None:
+        base_urls.pop(name, None)
+    else:
+        base_urls[name] = url.rstrip("/")
+
+
+class TimeoutAdapter(requests.adapters.HTTPAdapter):
+    """要求にtimeoutが指定されていなければ、既定のtimeoutを使うアダプタ。"""
+
+    def __init__(self, timeout=TIMEOUT, **kwargs):
+        super().__init__(**kwargs)
+        self.timeout = timeout
+
+    def send(self, request, timeout=None, **kwargs):
+        if timeout is None:
+            timeout = self.timeout
+        return super().send(request, timeout=timeout, **kwargs)
+
+
+def new_session(
+    cache_name="airpollution",
+    backend="sqlite",
+    pool_connections=10,
+    pool_maxsize=10,
+    keep_alive=True,
+    cache_dir=None,
+    timeout=TIMEOUT,
+    **kwargs,
+):
+    """接続プールの大きさを指定してキャッシュつきのセッションを作る。
+
+    backendはcachestore.BACKENDSのどれか。キャッシュはcache_dir/cache_nameに置く。
+    timeoutは、個々の要求で指定しなかったときのHTTPのタイムアウト。
+    kwargsはrequests_cache.CachedSessionにそのまま渡す。
+    """
+    kwargs.setdefault("urls_expire_after", urls_expire_after)
+    # 静岡県はPOSTでデータを返すので、POSTもキャッシュする(本文もキーに入る)。
+    kwargs.setdefault("allowable_methods", ("GET", "HEAD", "POST"))
+    directory = cachestore.cache_dir(cache_dir)
+    if directory and backend != "memory":
+        os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, cache_name)
+    session = requests_cache.CachedSession(
+        path, backend=cachestore.backend(backend, path), **kwargs
+    )
+    adapter = TimeoutAdapter(
+        timeout, pool_connections=pool_connections, pool_maxsize=pool_maxsize
+    )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if not keep_alive:
+        session.headers["Connection"] = "close"
+    # instrumentのsinkがなければ何もしない。
+    instrument.attach(session)
+    return session
+
+
+def configure(**kwargs):
+    """共有セッションの設定を変える。次にget_session()したときに作りなおされる。"""
+    global _session, _fixed
+    with _lock:
+        settings.update(kwargs)
+        _session = None
+        _shards.clear()
+        _fixed = False
+
+
+def set_session(session):
+    """呼び出し側で用意したセッションを共有セッションにする。"""
+    global _session, _fixed
+    with _lock:
+        _session = session
+        _shards.clear()
+        _fixed = True
+
+
+def get_session(name=None):
+    """共有セッションを返す。なければ作る。
+
+    settings["shard"]がTrueなら、取得元nameごとに別のキャッシュを使うセッションを返す。
+    """
+    global _session
+    options = dict(settings)
+    shard = options.pop("shard")
+    with _lock:
+        if shard and name is not None and not _fixed:
+            if name not in _shards:
+                options["cache_name"] = f"{options['cache_name']}-{name}"
+                _shards[name] = new_session(**options)
+            return _shards[name]
+        if _session is None:
+            _session = new_session(**options)
+        return _session
+
+
+def sessions():
+    """これまでに作った共有セッション(取得元ごとのものを含む)。"""
+    with _lock:
+        return [s for s in [_session] + list(_shards.values()) if s is not None]
+
+
+def expire_after(isotime, now=None):
+    """isotimeの時刻の毎時データをキャッシュしておく秒数。確定した時間なら無期限。"""
+    t = datetime.datetime.fromisoformat(isotime)
+    if now is None:
+        now = datetime.datetime.now(t.tzinfo)
+    age = now - t
+    if age >= FINAL_AFTER:
+        return requests_cache.NEVER_EXPIRE
+    if age >= datetime.timedelta(hours=1):
+        return RECENT_TTL
+    return CURRENT_TTL
+
+
+def _checkpoint(responses):
+    # WALモードでは、WALファイルの中身を本体に書きもどしてから大きさを測る。
+    if getattr(responses, "wal", False):
+        with responses.connection() as con:
+            con.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+def compact_cache(max_bytes=None, session=None, names=()):
+    """キャッシュから期限切れの応答を消す。
+
+    sessionを省くと、共有セッションと取得元ごとのセッション(sessions())のキャッシュを縮める。
+    namesの取得元のセッションは、まだ作っていなければ作ってから縮める。
+    SQLiteのキャッシュがmax_bytes(キャッシュごとの上限)より大きければ、期限の近いもの、
+    無期限のものは古く書きこまれたものから消して、VACUUMで縮める。
+    ファイルのキャッシュでは古いファイルから消す。
+    消したあとのキャッシュの大きさ(バイト)の合計を返す。わからなければNone。
+    """
+    if session is not None:
+        return _compact(session.cache, max_bytes)
+    get_session()
+    for name in names:
+        get_session(name)
+    sizes = [_compact(s.cache, max_bytes) for s in sessions()]
+    return None if None in sizes else sum(sizes)
+
+
+def _compact(cache, max_bytes):
+    cache.delete(expired=True)
+    responses = cache.responses
+    if not hasattr(responses, "size"):
+        return None
+    _checkpoint(responses)
+    size = responses.size()
+    if max_bytes is None or size <= max_bytes:
+        return size
+
+    if isinstance(responses, FileDict):
+        for path in sorted(responses.paths(), key=os.path.getmtime):
+            if size <= max_bytes:
+                break
+            size -= os.path.getsize(path)
+            os.unlink(path)
+        return responses.size()
+
+    # 値の大きさの合計で見積もって、一度に消す。
+    excess = size - max_bytes
+    keys = []
+    with responses.connection() as con:
+        rows = con.execute(
+            f"SELECT key, LENGTH(value) FROM {responses.table_name}"
+            " ORDER BY expires IS NULL, expires, rowid"
+        )
+        for key, length in rows:
+            if excess <= 0:
+                break
+            keys.append(key)
+            excess -= length
+        # 読みかけの文があるとVACUUMできない。
+        rows.close()
+    cache.delete(*keys, vacuum=False)
+    responses.vacuum()
+    _checkpoint(responses)
+    return responses.size()
+
+
+def main():
+    from airpollutionwatch import sources
+
+    parser = argparse.ArgumentParser(description="compact the HTTP cache")
+    parser.add_argument("--cache-name", default=settings["cache_name"])
+    parser.add_argument("--cache-dir", default=settings["cache_dir"])
+    parser.add_argument("--backend", default=settings["backend"])
+    parser.add_argument("--max-mb", type=float, help="size cap per cache in MB")
+    parser.add_argument(
+        "--shard", action="store_true", help="also compact per-source caches"
+    )
+    parser.add_argument(
+        "--sources",
+        nargs="*",
+        default=[*sources.SOURCES, "amedas"],
+        help="sources whose caches --shard compacts",
+    )
+    args = parser.parse_args()
+
+    configure(
+        cache_name=args.cache_name,
+        cache_dir=args.cache_dir,
+        backend=args.backend,
+        shard=args.shard,
+    )
+    get_session()
+    for name in args.sources if args.shard else []:
+        get_session(name)
+    max_bytes = None if args.max_mb is None else int(args.max_mb * 2**20)
+    for s in sessions():
+        responses = s.cache.responses
+        before = responses.size() if hasattr(responses, "size") else None
+        after = compact_cache(max_bytes, session=s)
+        print(f"{s.cache.cache_name}: {before} -> {after} bytes")
+
+
+if __name__ == "__main__":
+    main()
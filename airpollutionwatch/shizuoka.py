@@ -2,13 +2,13 @@ import sys
 
 sys.path.insert(0, "..")  # for debug
 
-import io
 import datetime
 
 # import requests
-import requests_cache
 import pandas as pd
 import numpy as np
+from airpollutionwatch.session import get_session, base_url, expire_after
+from airpollutionwatch import batch, aio, htmltable, instrument
 
 try:
     from airpollutionwatch.convert import (
@@ -28,6 +28,7 @@ try:
         TEMP,
         HUM,
         STATION,
+        compacted,
     )
 except:
     from convert import (
@@ -47,9 +48,19 @@ except:
         TEMP,
         HUM,
         STATION,
+        compacted,
     )
 
 
+# データの置かれている場所。session.override_base_url("shizuoka", url)で変えられる。
+BASE_URL = "https://taikikanshi.pref.shizuoka.jp"
+
+# データの置かれているホスト。aioでの同時接続数の制限に使う。
+HOST = "taikikanshi.pref.shizuoka.jp"
+
+# 都道府県コード(静岡県)。測定局名はまずこの中で探す。
+PREF = 22
+
 # ウェブ上の表記と、国環研の表記との対応
 aliases = {
     "下田総合庁舎": "下田総合庁舎",  # not found
@@ -70,10 +81,13 @@ aliases = {
     "引佐": "引佐測定局",
 }
 
+# 数値に変換しない列
+text_columns = ("地域", "測定局名", "種別")
+
 # apparent nameと内部標準名(そらまめ名)の変換
 converters = {
     # "地域",
-    "測定局名": lambda x: STATION(x, aliases=aliases),
+    "測定局名": lambda x: STATION(x, aliases=aliases, pref=PREF),
     # "測定局",
     # "種別",
     "二酸化硫黄SO2(ppm)": lambda x: SO2(x, unit="ppm"),
@@ -94,6 +108,7 @@ converters = {
 }
 
 
+@instrument.timed("retrieve_raw", "shizuoka")
 def retrieve_raw(isotime):
     """指定された日時のデータを入手する。index名とcolumn名は生のまま。"""
     dt = datetime.datetime.fromisoformat(isotime)
@@ -106,17 +121,23 @@ def retrieve_raw(isotime):
         "operation": "non",
         # "_token": "XYZ468SEcJMjhXEW4CNgmcadv7D7w7JlpSzQBhzu"
     }
-    session = requests_cache.CachedSession("airpollution")
+    session = get_session("shizuoka")
     response = session.post(
-        "https://taikikanshi.pref.shizuoka.jp/jiho",
+        f"{base_url('shizuoka', BASE_URL)}/jiho",
         data=data,
+        expire_after=expire_after(isotime),
     )
-    dfs = pd.read_html(io.StringIO(response.text))
-    return dfs[0]
+    doc = htmltable.parse(response.text)
+    htmltable.check_form(doc, {"date": date, "time": time})
+    return htmltable.table(doc, text_columns=text_columns)
+
 
+@instrument.timed("retrieve", "shizuoka")
+def retrieve(isotime, station_set="full", compact=False):
+    """指定された日時のデータを入手する。index名とcolumn名をつけなおし、単位をそらまめにあわせる。
 
-def retrieve(isotime, station_set="full"):
-    """指定された日時のデータを入手する。index名とcolumn名をつけなおし、単位をそらまめにあわせる。"""
+    compactにTrueか"scaled"を与えると、convert.compacted()で型を小さくする。
+    """
     df = retrieve_raw(isotime)
     # with open("tmp.pickle", "wb") as f:
     #     pickle.dump(df, f)
@@ -135,7 +156,37 @@ def retrieve(isotime, station_set="full"):
         selection = [type(i) != str and (10000000 <= i <= 99999999) for i in df.index]
         df = df.iloc[selection]
 
-    return df
+    return compacted(df, compact)
+
+
+async def aretrieve(isotime, station_set="full", compact=False):
+    """retrieve()のasyncio版。HOSTへの同時接続数はaioで制限される。"""
+    return await aio.run(
+        HOST, retrieve, isotime, station_set=station_set, compact=compact
+    )
+
+
+def retrieve_range(
+    start,
+    end,
+    station_set="full",
+    max_workers=batch.MAX_WORKERS,
+    compact=False,
+    errors="raise",
+):
+    """startからendまでの毎時のデータを並行して入手し、(time, station)をindexとする1つのDataFrameにまとめる。
+
+    errorsは取得に失敗した時刻の扱い。batch.retrieve_range()を参照。
+    """
+    return batch.retrieve_range(
+        retrieve,
+        start,
+        end,
+        max_workers=max_workers,
+        errors=errors,
+        compact=compact,
+        station_set=station_set,
+    )
 
 
 def test():
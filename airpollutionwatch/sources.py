@@ -0,0 +1,85 @@
+"""大気常時監視データの取得元の一覧と、全取得元からの一括取得。"""
+
+import importlib
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+from logging import getLogger
+
+import pandas as pd
+
+# 取得元の名前と、retrieve(isotime, station_set)をもつモジュール
+SOURCES = {
+    "kanagawa": "airpollutionwatch.kanagawa",
+    "chiba": "airpollutionwatch.chiba",
+    "tokyo": "airpollutionwatch.tokyo",
+    "yamanashi": "airpollutionwatch.yamanashi",
+    "shizuoka": "airpollutionwatch.shizuoka",
+}
+
+# retrieve_all()で1つの取得元を待つ秒数
+TIMEOUT = 120
+
+
+def register(name, module):
+    """取得元を追加する。moduleはモジュールそのものか、モジュール名。"""
+    SOURCES[name] = module
+
+
+def source(name):
+    """取得元のモジュールを返す。"""
+    module = SOURCES[name]
+    if isinstance(module, str):
+        module = importlib.import_module(module)
+    return module
+
+
+def _retrieve(name, isotime, station_set):
+    start = time.perf_counter()
+    try:
+        df = source(name).retrieve(isotime, station_set=station_set)
+        error = None
+    except Exception as e:
+        df = None
+        error = repr(e)
+    return df, time.perf_counter() - start, error
+
+
+def retrieve_all(isotime, station_set="air", sources=None, timeout=TIMEOUT):
+    """すべての取得元から、指定された日時のデータを並行して入手する。
+
+    国環研局番をindexとし、取得元をsource列に入れた1つのDataFrameと、
+    取得元ごとの所要時間(秒)、行数、エラーをまとめたDataFrameを返す。
+    ある取得元が失敗しても、ほかの取得元の結果は返す。
+    timeout秒たっても終わらない取得元は待たずに、エラーとして報告する。
+    """
+    logger = getLogger()
+    names = list(SOURCES if sources is None else sources)
+    executor = ThreadPoolExecutor(max_workers=len(names) or 1)
+    futures = [executor.submit(_retrieve, name, isotime, station_set) for name in names]
+    wait(futures, timeout=timeout)
+    # 終わらないスレッドは止められないので、待たずに残しておく。
+    executor.shutdown(wait=False, cancel_futures=True)
+    results = [
+        (
+            future.result()
+            if future.done()
+            else (None, timeout, f"timed out after {timeout} seconds")
+        )
+        for future in futures
+    ]
+
+    frames = []
+    report = []
+    for name, (df, seconds, error) in zip(names, results):
+        if error is not None:
+            logger.warning(f"{name}: {error}")
+            report.append((name, seconds, 0, error))
+            continue
+        frames.append(df.assign(source=name))
+        report.append((name, seconds, len(df), None))
+
+    df = pd.concat(frames) if frames else pd.DataFrame(columns=["source"])
+    report = pd.DataFrame(
+        report, columns=["source", "seconds", "rows", "error"]
+    ).set_index("source")
+    return df, report
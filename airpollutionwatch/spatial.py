@@ -0,0 +1,212 @@
+"""大気測定局(国環研局番)ごとに、近いアメダス地点を引く。
+
+測定局とアメダス地点の経度緯度を単位球面上のベクトルにして、弦の長さで近い順に並べる
+(弦の長さの順は大円距離の順と同じ)。全国の測定局×地点でも行列の積で済むので、
+KD木などは使わない。結果はHTTPキャッシュと同じディレクトリにnpzで保存しておき、
+測定局一覧か地点表が変わったときだけ作りなおす。
+
+    df = spatial.attach(tokyo.retrieve(isotime), amedas.retrieve(isotime))
+"""
+
+import hashlib
+import os
+import threading
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from airpollutionwatch import amedas, cachestore, registry, session
+from airpollutionwatch.memo import ttl_cache, METADATA_TTL
+
+# 測定局ごとに求めておく、近い地点の数
+K = 4
+
+# 地球の半径(km)
+EARTH_RADIUS = 6371.0
+
+# 一度に距離を計算する測定局の数。距離の行列の大きさを抑える。
+CHUNK = 512
+
+
+def unit_vectors(lon, lat):
+    """経度緯度(度)を、単位球面上の(x, y, z)の配列にする。"""
+    lon = np.deg2rad(np.asarray(lon, dtype=float))
+    lat = np.deg2rad(np.asarray(lat, dtype=float))
+    return np.stack(
+        [np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)], axis=-1
+    )
+
+
+def nearest(points, candidates, k):
+    """pointsのそれぞれについて、candidatesのうち近いk個の位置と大円距離(km)を返す。
+
+    どちらも単位ベクトルの配列で、近い順に並べる。
+    位置の分からない点は、位置が-1、距離がNaNになる。
+    """
+    pool = np.flatnonzero(~np.isnan(candidates).any(axis=1))
+    k = min(k, len(pool))
+    index = np.full((len(points), k), -1, dtype=np.int64)
+    chord = np.full((len(points), k), np.nan)
+    rows = np.flatnonzero(~np.isnan(points).any(axis=1))
+    if k == 0:
+        return index, chord
+    for start in range(0, len(rows), CHUNK):
+        chunk = rows[start : start + CHUNK]
+        # 単位ベクトルどうしの弦の長さの2乗は2 - 2a・b
+        d2 = np.maximum(2 - 2 * points[chunk] @ candidates[pool].T, 0)
+        part = np.argpartition(d2, k - 1, axis=1)[:, :k]
+        part = np.take_along_axis(
+            part, np.take_along_axis(d2, part, axis=1).argsort(axis=1), axis=1
+        )
+        index[chunk] = pool[part]
+        chord[chunk] = np.sqrt(np.take_along_axis(d2, part, axis=1))
+    return index, 2 * EARTH_RADIUS * np.arcsin(chord / 2)
+
+
+def _digest(arrays, table, k):
+    # 測定局一覧と地点表の位置と標高が同じなら、同じ結果になる。
+    h = hashlib.sha1(str(k).encode())
+    for values in (
+        arrays["code"],
+        arrays["lon"],
+        arrays["lat"],
+        arrays["alt"],
+        table.index.astype(int),
+        table["lon"],
+        table["lat"],
+        table["alt"],
+    ):
+        h.update(np.ascontiguousarray(np.asarray(values, dtype=float)).tobytes())
+    return h.hexdigest()
+
+
+def build(k=K):
+    """すべての測定局について、近いk個のアメダス地点の配列を作る。
+
+    station: 国環研局番
+    amedas: 近い順の地点番号(測定局×k)。位置の分からない測定局は-1。
+    distance_km: 大円距離
+    alt_diff: アメダス地点の標高 - 測定局の標高(m)
+    """
+    arrays = registry.load()
+    table = amedas.station_table()
+    index, distance = nearest(
+        unit_vectors(arrays["lon"], arrays["lat"]),
+        unit_vectors(table["lon"], table["lat"]),
+        k,
+    )
+    found = index >= 0
+    codes = table.index.astype(int).to_numpy()
+    alt = table["alt"].to_numpy(dtype=float)
+    station_alt = np.asarray(arrays["alt"], dtype=float)[:, None]
+    return {
+        "station": arrays["code"],
+        "amedas": np.where(found, codes[index], -1),
+        "distance_km": distance.astype(np.float32),
+        "alt_diff": np.where(found, alt[index] - station_alt, np.nan).astype(
+            np.float32
+        ),
+        "digest": np.array(_digest(arrays, table, k)),
+    }
+
+
+def path(k=K):
+    """近い地点の配列を保存するファイル。HTTPキャッシュと同じディレクトリに置く。"""
+    directory = cachestore.cache_dir(session.settings["cache_dir"])
+    return os.path.join(directory, f"amedas_neighbours-k{k}.npz")
+
+
+@ttl_cache(METADATA_TTL)
+def _arrays(k=K):
+    logger = getLogger()
+    filename = path(k)
+    digest = _digest(registry.load(), amedas.station_table(), k)
+    try:
+        with np.load(filename, allow_pickle=False) as npz:
+            if str(npz["digest"]) == digest:
+                return {key: npz[key] for key in npz.files}
+        logger.info(f"{filename} is outdated.")
+    except FileNotFoundError:
+        logger.info(f"{filename} not found.")
+    arrays = build(k)
+    # 書きかけのファイルを読まれないように、一時ファイルに書いてから置きかえる。
+    tmp = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp, filename)
+    except OSError as e:
+        # 書けない場合はメモリ上だけで使う。
+        logger.warning(f"{filename}: {e}")
+    return arrays
+
+
+def neighbours(k=K):
+    """国環研局番ごとに、近い順にk個のアメダス地点を並べたDataFrame。
+
+    (station, rank)をindexとし、amedas(地点番号)、distance_km(大円距離)、
+    alt_diff(アメダス地点の標高 - 測定局の標高, m)の列を持つ。
+    """
+    arrays = _arrays(k)
+    n, k = arrays["amedas"].shape
+    index = pd.MultiIndex.from_arrays(
+        [np.repeat(arrays["station"], k), np.tile(np.arange(k), n)],
+        names=["station", "rank"],
+    )
+    return pd.DataFrame(
+        {
+            "amedas": arrays["amedas"].ravel(),
+            "distance_km": arrays["distance_km"].ravel(),
+            "alt_diff": arrays["alt_diff"].ravel(),
+        },
+        index=index,
+    )
+
+
+def attach(df, weather, columns=None, k=1, prefix="amedas_"):
+    """大気のDataFrameに、測定局ごとに最も近いアメダス地点の気象データの列を加える。
+
+    dfは国環研局番(station)か(time, station)をindexとするもの。
+    weatherはamedas.retrieve()などの、地点番号か(time, 地点番号)をindexとするもの。
+    columnsは加える列(既定ではweatherのすべての列)で、列名にはprefixをつける。
+    k>1なら、近い地点の値が欠けているとき、k番目に近い地点までの値で埋める。
+    最も近い地点の番号と距離も、<prefix>codeと<prefix>distance_kmとして加える。
+    """
+    columns = list(weather.columns if columns is None else columns)
+    arrays = _arrays(max(k, K))
+    k = min(k, arrays["amedas"].shape[1])
+
+    row = pd.Index(arrays["station"]).get_indexer(df.index.get_level_values("station"))
+    known = row >= 0
+    codes = np.where(known[:, None], arrays["amedas"][row], -1)
+    distance = np.where(known[:, None], arrays["distance_km"][row], np.nan)
+
+    if "time" in df.index.names:
+        times = df.index.get_level_values("time")
+        positions = [
+            weather.index.get_indexer(pd.MultiIndex.from_arrays([times, codes[:, r]]))
+            for r in range(k)
+        ]
+    else:
+        positions = [weather.index.get_indexer(codes[:, r]) for r in range(k)]
+
+    out = df.copy()
+    out[f"{prefix}code"] = codes[:, 0]
+    out[f"{prefix}distance_km"] = distance[:, 0]
+    for col in columns:
+        # 位置-1はRangeIndexにないので、reindexで欠損になる。
+        column = weather[col].reset_index(drop=True)
+        filled = column.reindex(positions[0]).reset_index(drop=True)
+        for pos in positions[1:]:
+            filled = filled.fillna(column.reindex(pos).reset_index(drop=True))
+        out[f"{prefix}{col}"] = filled.array
+    return out
+
+
+def test():
+    print(neighbours().head(8))
+
+
+if __name__ == "__main__":
+    test()
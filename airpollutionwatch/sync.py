@@ -0,0 +1,166 @@
+"""アーカイブを最新の状態に保つ常駐処理。
+
+取得元ごとに、最後に保存できた時刻(high-water mark)をroot/sync.jsonに記録しておき、
+それより新しい時刻と、直近lookbackの間にアーカイブに抜けている時刻だけを取得する。
+保存済みの時刻は取りなおさない。
+
+    python -m airpollutionwatch.sync --root airpollution-archive --interval 600
+"""
+
+import argparse
+import datetime
+import importlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger, basicConfig, INFO
+
+import pandas as pd
+
+from airpollutionwatch import archive, batch
+from airpollutionwatch.sources import SOURCES as AIR_SOURCES, source
+
+# 同期する取得元
+SOURCES = ["tokyo", "kanagawa", "chiba", "yamanashi", "shizuoka", "amedas"]
+
+# 毎時のデータが公開されるまでの猶予。これより新しい時刻はまだ取りにいかない。
+DELAY = datetime.timedelta(hours=1)
+
+# 抜けている時刻を探す範囲
+LOOKBACK = datetime.timedelta(hours=48)
+
+# 抜けを埋めるときに、まとめて取得して保存する時間数。
+# 長い停止のあとで途中で落ちても、保存した分は取りなおさない。
+CHUNK_HOURS = 24
+
+
+def _module(name):
+    if name in AIR_SOURCES:
+        return source(name)
+    return importlib.import_module(f"airpollutionwatch.{name}")
+
+
+def _state_path(root):
+    return os.path.join(root, "sync.json")
+
+
+def load_state(root=archive.ROOT):
+    """取得元ごとのhigh-water markを読む。"""
+    try:
+        with open(_state_path(root)) as f:
+            return {name: pd.Timestamp(t) for name, t in json.load(f).items()}
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(state, root=archive.ROOT):
+    os.makedirs(root, exist_ok=True)
+    path = _state_path(root)
+    with open(path + ".tmp", "w") as f:
+        json.dump({name: t.isoformat() for name, t in state.items()}, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def _fetch(module, t):
+    logger = getLogger()
+    try:
+        return module.retrieve(t.isoformat())
+    except Exception as e:
+        logger.warning(f"{module.__name__} {t.isoformat()}: {e!r}")
+        return None
+
+
+def backfill(
+    name,
+    start,
+    end,
+    root=archive.ROOT,
+    max_workers=batch.MAX_WORKERS,
+    on_saved=None,
+):
+    """取得元nameについて、startからendまでのうちアーカイブにない時刻を取得して保存する。
+
+    古い時刻からCHUNK_HOURSずつ取得して保存し、保存するたびに
+    on_saved(保存できた時刻のリスト)を呼ぶ。保存できた時刻のリストを返す。
+    """
+    logger = getLogger()
+    wanted = [pd.Timestamp(t) for t in batch.hours(start, end)]
+    archived = archive.hours(name, start, end, root=root)
+    missing = [t for t in wanted if t not in archived]
+    if not missing:
+        return []
+    logger.info(f"{name}: fetching {len(missing)} hours")
+
+    module = _module(name)
+    saved = []
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for i in range(0, len(missing), CHUNK_HOURS):
+            chunk = missing[i : i + CHUNK_HOURS]
+            frames = list(executor.map(lambda t: _fetch(module, t), chunk))
+            done = [t for t, df in zip(chunk, frames) if df is not None and len(df) > 0]
+            if not done:
+                continue
+            df = pd.concat(
+                [df for df in frames if df is not None and len(df) > 0],
+                keys=done,
+                names=["time"],
+            )
+            archive.append(df, name, root=root)
+            saved += done
+            if on_saved is not None:
+                on_saved(done)
+    return saved
+
+
+def tick(now=None, sources=SOURCES, root=archive.ROOT, lookback=LOOKBACK):
+    """すべての取得元について、high-water mark以降と直近lookbackの抜けを埋める。
+
+    high-water markは、backfill()が保存するたびに書きだす。
+    """
+    state = load_state(root)
+    now = pd.Timestamp.now(tz=archive.TZ) if now is None else archive.timestamp(now)
+    end = (now - DELAY).floor("h")
+    for name in sources:
+        start = end - lookback
+        if name in state:
+            start = min(start, state[name] + datetime.timedelta(hours=1))
+
+        def saved(done, name=name):
+            state[name] = max([state.get(name, done[0])] + done)
+            save_state(state, root)
+
+        backfill(name, start.isoformat(), end.isoformat(), root=root, on_saved=saved)
+    return state
+
+
+def run(interval=600, sources=SOURCES, root=archive.ROOT, lookback=LOOKBACK):
+    """interval秒ごとにtick()をくりかえす。"""
+    logger = getLogger()
+    while True:
+        try:
+            tick(sources=sources, root=root, lookback=lookback)
+        except Exception as e:
+            logger.error(f"sync failed: {e!r}")
+        time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--root", default=archive.ROOT)
+    parser.add_argument("--interval", type=float, default=600)
+    parser.add_argument("--lookback", type=float, default=48, help="hours")
+    parser.add_argument("--once", action="store_true")
+    parser.add_argument("sources", nargs="*", default=SOURCES)
+    args = parser.parse_args()
+
+    basicConfig(level=INFO)
+    lookback = datetime.timedelta(hours=args.lookback)
+    if args.once:
+        tick(sources=args.sources, root=args.root, lookback=lookback)
+    else:
+        run(args.interval, sources=args.sources, root=args.root, lookback=lookback)
+
+
+if __name__ == "__main__":
+    main()
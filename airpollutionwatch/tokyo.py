@@ -2,12 +2,9 @@ import sys
 
 sys.path.insert(0, "..")  # for debug
 
-import io
-import datetime
-from logging import getLogger, basicConfig, INFO, DEBUG
-import requests_cache
-import pandas as pd
-import numpy as np
+from logging import basicConfig, DEBUG
+from airpollutionwatch import batch, aio
+from airpollutionwatch.v50x import V50xSource
 
 try:
     from convert import (
@@ -26,7 +23,6 @@ try:
         WS,
         TEMP,
         HUM,
-        STATION,
     )
 except:
     from airpollutionwatch.convert import (
@@ -45,10 +41,18 @@ except:
         WS,
         TEMP,
         HUM,
-        STATION,
     )
 
 
+# データの置かれている場所。session.override_base_url("tokyo", url)で変えられる。
+BASE_URL = "https://www.taiki.kankyo.metro.tokyo.lg.jp/taikikankyo/data"
+
+# データの置かれているホスト。aioでの同時接続数の制限に使う。
+HOST = "www.taiki.kankyo.metro.tokyo.lg.jp"
+
+# 都道府県コード(東京都)。測定局名はまずこの中で探す。
+PREF = 13
+
 # ウェブ上の表記と、国環研の表記との対応
 aliases = {
     "国設東京新宿": "国設東京（新宿）",
@@ -65,7 +69,6 @@ aliases = {
 # apparent nameと内部標準名(そらまめ名)の変換
 converters = {
     # "地域",
-    "name": lambda x: STATION(x, aliases=aliases),
     # "測定局",
     # "種別",
     "SO2": lambda x: SO2(x, unit="ppb"),
@@ -86,82 +89,50 @@ converters = {
 }
 
 
-def stations():
-    """独自の測定局コードと測定局名の関係を定義するファイルを入手する。"""
-    # dfs = pd.DataFrame.from_dict(STATIONS, orient="index")  # .transpose()
-    session = requests_cache.CachedSession("airpollution")
-    response = session.get(
-        "https://www.taiki.kankyo.metro.tokyo.lg.jp/taikikankyo/data/V501Station.json",
+source = V50xSource(
+    "tokyo",
+    BASE_URL,
+    aliases=aliases,
+    converters=converters,
+    pref=PREF,
+    hourly_dir="hour/",
+)
+stations = source.stations
+items = source.items
+station_map = source.station_map
+item_map = source.item_map
+retrieve_raw = source.retrieve_raw
+retrieve = source.retrieve
+
+
+async def aretrieve(isotime, station_set="full", compact=False):
+    """retrieve()のasyncio版。HOSTへの同時接続数はaioで制限される。"""
+    return await aio.run(
+        HOST, retrieve, isotime, station_set=station_set, compact=compact
     )
-    dfs = pd.read_json(io.StringIO(response.text), orient="index")  # .transpose()
-    return dfs
 
 
-def items():
-    """独自の測定量コードと測定量名の関係を定義するファイルを入手する。"""
-    # dfs = pd.DataFrame.from_dict(ITEMS, orient="index")  # .transpose()
-    session = requests_cache.CachedSession("airpollution")
-    response = session.get(
-        "https://www.taiki.kankyo.metro.tokyo.lg.jp/taikikankyo/data/V502Item.json",
-    )
-    dfs = pd.read_json(io.StringIO(response.text), orient="index")  # .transpose()
-    return dfs
-
-
-def retrieve_raw(isotime):
-    # dt = datetime.datetime.fromisoformat(isotime)
-    # date_time = dt.strftime("%Y%m%d%H")
-    logger = getLogger()
-    dt = datetime.datetime.fromisoformat(isotime)
-    date_time = dt.strftime("%Y%m%d%H")
-    if date_time[-2:] == "00":
-        logger.debug(f"Date spec {date_time} is invalid.")
-        # 00時は存在しないので、前日の24時に書きかえる。
-        date_time = (dt - datetime.timedelta(hours=1)).strftime("%Y%m%d") + "24"
-        logger.debug(f"Modified to {date_time}.")
-
-    session = requests_cache.CachedSession("airpollution")
-    response = session.get(
-        f"https://www.taiki.kankyo.metro.tokyo.lg.jp/taikikankyo/data/hour/{date_time[:6]}/{date_time}.json",
+def retrieve_range(
+    start,
+    end,
+    station_set="full",
+    max_workers=batch.MAX_WORKERS,
+    compact=False,
+    errors="raise",
+):
+    """startからendまでの毎時のデータを並行して入手し、(time, station)をindexとする1つのDataFrameにまとめる。
+
+    errorsは取得に失敗した時刻の扱い。batch.retrieve_range()を参照。
+    """
+    return batch.retrieve_range(
+        retrieve,
+        start,
+        end,
+        max_workers=max_workers,
+        errors=errors,
+        compact=compact,
+        station_set=station_set,
     )
-    # # これがないと文字化けする
-    # response.encoding = response.apparent_encoding
-    # with open("tmp.txt", "w") as f:
-    #     f.write(response.text)
-    # with open("tmp.txt", "r") as f:
-    #     text = f.read()
-
-    dfs = pd.read_json(io.StringIO(response.text)).transpose()
-    return dfs
-
-
-def retrieve(isotime, station_set="full"):
-    """指定された日時のデータを入手する。index名とcolumn名をつけなおし、単位をそらまめにあわせる。"""
-    df = retrieve_raw(isotime)
-    item_map = items()["simpleName"].to_dict()
-    # データをpyから読む場合は、codeが整数化されてしまう。
-    item_map = {int(x): y for x, y in item_map.items()}
-
-    station_map = stations()["name"].to_dict()
-    # データをpyから読む場合は、codeが整数化されてしまう。
-    station_map = {int(x): y for x, y in station_map.items()}
-
-    df = df.rename(index=station_map, columns=item_map)
-    df["name"] = df.index
-
-    cols = []
-    for col in df.columns:
-        if col in converters:
-            cols.append(converters[col](df[col]))
-    df = pd.concat(cols, axis=1).set_index("station")
-
-    if station_set == "air":
-        # station_mapに含まれる測定局のみに絞る
-        # selection = [isinstance(i, np.int64) for i in df.index]
-        selection = [type(i) != str and (10000000 <= i <= 99999999) for i in df.index]
-        df = df.iloc[selection]
-
-    return df
 
 
 def test():
@@ -0,0 +1,185 @@
+"""V501Station.json/V502Item.jsonと毎時のJSONでデータを公開している自治体の共通処理。
+
+東京都、神奈川県、山梨県は同じシステムを使っていて、違うのはURLと局名の別名と単位だけ。
+"""
+
+import datetime
+from logging import getLogger
+
+import numpy as np
+import pandas as pd
+
+from airpollutionwatch.convert import STATION, compacted
+from airpollutionwatch.fastjson import loads, records
+from airpollutionwatch.memo import ttl_cache, METADATA_TTL
+from airpollutionwatch import framecache, instrument, session
+from airpollutionwatch.session import get_session
+
+
+class V50xSource:
+    """V501/V502形式の取得元。
+
+    name: 取得元の名前。session.base_url()でURLを上書きするときに使う。
+    base_url: V501Station.jsonの置かれているURL
+    aliases: ウェブ上の表記と、国環研の表記との対応
+    converters: 測定量名(simpleName)と、単位をそらまめにあわせる関数との対応
+    pref: 都道府県コード。測定局名はまずこの中で探す。
+    hourly_dir: 毎時のJSONが置かれている、base_urlからの相対パス
+    """
+
+    def __init__(self, name, base_url, aliases, converters, pref=None, hourly_dir=""):
+        self.name = name
+        self.default_url = base_url
+        self.aliases = aliases
+        self.converters = converters
+        self.pref = pref
+        self.hourly_dir = hourly_dir
+
+    @property
+    def base_url(self):
+        return session.base_url(self.name, self.default_url)
+
+    @instrument.method("stations")
+    def stations(self):
+        """独自の測定局コードと測定局名の関係を定義するファイルを入手する。"""
+        response = get_session(self.name).get(f"{self.base_url}/V501Station.json")
+        return records(response.content)
+
+    @instrument.method("items")
+    def items(self):
+        """独自の測定量コードと測定量名の関係を定義するファイルを入手する。"""
+        response = get_session(self.name).get(f"{self.base_url}/V502Item.json")
+        return records(response.content)
+
+    @ttl_cache(METADATA_TTL)
+    def _station_map(self):
+        # データをpyから読む場合は、codeが整数化されてしまう。
+        mapping = {int(x): y for x, y in self.stations()["name"].to_dict().items()}
+        # 対応が変わったかどうかを、framecacheのキーで見分けるための値もつける。
+        return hash(tuple(sorted(mapping.items()))), mapping
+
+    @ttl_cache(METADATA_TTL)
+    def _item_map(self):
+        mapping = {int(x): y for x, y in self.items()["simpleName"].to_dict().items()}
+        return hash(tuple(sorted(mapping.items()))), mapping
+
+    def station_map(self):
+        """測定局コードから測定局名への対応。一定時間メモしておく。"""
+        return self._station_map()[1]
+
+    def item_map(self):
+        """測定量コードから測定量名への対応。一定時間メモしておく。"""
+        return self._item_map()[1]
+
+    def url(self, isotime):
+        """指定された日時の毎時のJSONのURL。"""
+        logger = getLogger()
+        dt = datetime.datetime.fromisoformat(isotime)
+        date_time = dt.strftime("%Y%m%d%H")
+        if date_time[-2:] == "00":
+            logger.debug(f"Date spec {date_time} is invalid.")
+            # 00時は存在しないので、前日の24時に書きかえる。
+            date_time = (dt - datetime.timedelta(hours=1)).strftime("%Y%m%d") + "24"
+            logger.debug(f"Modified to {date_time}.")
+        return f"{self.base_url}/{self.hourly_dir}{date_time[:6]}/{date_time}.json"
+
+    def request(self, isotime):
+        """指定された日時の毎時のJSONを取得し、応答を返す。"""
+        return get_session(self.name).get(
+            self.url(isotime), expire_after=session.expire_after(isotime)
+        )
+
+    def fetch(self, isotime):
+        """指定された日時の毎時のJSONを辞書で返す。{測定局コード: {測定量コード: 値}}"""
+        return loads(self.request(isotime).content)
+
+    @instrument.method("retrieve_raw")
+    def retrieve_raw(self, isotime):
+        """指定された日時のデータを入手する。index名とcolumn名は生のまま。"""
+        data = self.fetch(isotime)
+        station_codes, item_codes, values = block(data)
+        return pd.DataFrame(
+            values,
+            index=[int(x) for x in station_codes],
+            columns=[int(x) for x in item_codes],
+        )
+
+    @instrument.method("retrieve_raw")
+    def fetch_block(self, isotime, key):
+        """retrieve()の取得と解析。(目印, DataFrameかNone, block()の結果かNone)を返す。
+
+        keyと応答が前回と同じならframecacheのDataFrameを返し、解析はしない。
+        """
+        response = self.request(isotime)
+        mark, df = framecache.lookup(key, response)
+        if df is not None:
+            return mark, df, None
+        return mark, None, block(loads(response.content))
+
+    @instrument.method("retrieve")
+    def retrieve(self, isotime, station_set="full", compact=False):
+        """指定された日時のデータを入手する。index名とcolumn名をつけなおし、単位をそらまめにあわせる。
+
+        station_setが"air"の場合は、大気測定局(8桁の局番があるもの)だけをリストする。
+        compactにTrueか"scaled"を与えると、convert.compacted()で型を小さくする。
+        """
+        assert station_set in ("full", "air")
+
+        station_version, station_map = self._station_map()
+        item_version, item_map = self._item_map()
+        # 前回と同じ応答で、測定局・測定量の対応も同じなら、解析も変換もしない。
+        key = (
+            self.name,
+            self.url(isotime),
+            station_set,
+            compact,
+            station_version,
+            item_version,
+        )
+        mark, df, parsed = self.fetch_block(isotime, key)
+        if df is not None:
+            return df
+
+        station_codes, item_codes, values = parsed
+
+        names = [station_map.get(int(x), int(x)) for x in station_codes]
+        cols = [STATION(pd.Series(names), aliases=self.aliases, pref=self.pref)]
+        for j, code in enumerate(item_codes):
+            item = item_map.get(int(code))
+            if item in self.converters:
+                cols.append(self.converters[item](pd.Series(values[:, j])))
+        df = pd.concat(cols, axis=1).set_index("station")
+
+        if station_set == "air":
+            # station_mapに含まれる測定局のみに絞る
+            selection = [
+                type(i) != str and (10000000 <= i <= 99999999) for i in df.index
+            ]
+            df = df.iloc[selection]
+
+        df = compacted(df, compact)
+        framecache.store(key, mark, df)
+        return df
+
+
+def block(data):
+    """{測定局コード: {測定量コード: 値}}を、測定局×測定量の数値の配列にする。
+
+    測定局コードのリスト、測定量コードのリスト、float64の2次元配列を返す。
+    数値でない値はNaNになる。
+    """
+    station_codes = list(data)
+    item_codes = {}
+    rows = []
+    cols = []
+    cells = []
+    for i, record in enumerate(data.values()):
+        for item, value in record.items():
+            rows.append(i)
+            cols.append(item_codes.setdefault(item, len(item_codes)))
+            cells.append(value)
+    values = np.full((len(station_codes), len(item_codes)), np.nan)
+    values[rows, cols] = pd.to_numeric(
+        pd.Series(cells, dtype=object), errors="coerce"
+    ).to_numpy(dtype=float, na_value=np.nan)
+    return station_codes, list(item_codes), values
@@ -0,0 +1,131 @@
+"""複数のプロセスから同じHTTPキャッシュを読み書きしたときの速さを、保存形式ごとに比べる。
+
+    python -m benchmarks.cache_backends [--processes 4] [--requests 200] [--size 20000]
+
+各プロセスは、別々のURLをrequests回取得して(キャッシュに書きこみ)、
+続けて同じURLをもう一度取得する(キャッシュから読みだす)。
+ネットワークには出ず、決まった大きさの本文を返すアダプタを使う。
+--shardをつけると、プロセスごとに別のキャッシュを使う(取得元ごとのshardに相当する)。
+"""
+
+import argparse
+import io
+import multiprocessing
+import tempfile
+import time
+
+import requests
+import urllib3
+
+from airpollutionwatch import cachestore, session
+
+
+class FixedAdapter(requests.adapters.BaseAdapter):
+    """どのURLにも同じ本文を返すアダプタ。"""
+
+    def __init__(self, content):
+        super().__init__()
+        self.content = content
+
+    def send(self, request, **kwargs):
+        headers = {"Content-Type": "application/json"}
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = urllib3.HTTPResponse(
+            body=io.BytesIO(self.content),
+            headers=headers,
+            status=200,
+            preload_content=False,
+            request_url=request.url,
+        )
+        response._content = self.content
+        response.headers.update(headers)
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def worker(args):
+    backend, directory, cache_name, index, requests_, size, start = args
+    content = (b'{"1": {"1": "0.012"}, ' * (size // 22 + 1))[:size]
+    target = session.new_session(cache_name, backend=backend, cache_dir=directory)
+    target.mount("https://", FixedAdapter(content))
+    urls = [f"https://bench.invalid/{index}/{i}.json" for i in range(requests_)]
+    # すべてのプロセスがそろってから始める。
+    start.wait()
+
+    errors = 0
+    t0 = time.perf_counter()
+    for url in urls:
+        try:
+            target.get(url)
+        except Exception:
+            errors += 1
+    t1 = time.perf_counter()
+    hits = 0
+    for url in urls:
+        try:
+            hits += target.get(url).from_cache
+        except Exception:
+            errors += 1
+    t2 = time.perf_counter()
+    return t1 - t0, t2 - t1, hits, errors
+
+
+def run(backend, processes, requests_, size, shard=False):
+    """backendについて、(挿入/秒, 参照/秒, キャッシュ当たりの割合, エラー数)を返す。"""
+    with tempfile.TemporaryDirectory() as directory:
+        with multiprocessing.Manager() as manager:
+            start = manager.Barrier(processes)
+            jobs = [
+                (
+                    backend,
+                    directory,
+                    f"bench-{i}" if shard else "bench",
+                    i,
+                    requests_,
+                    size,
+                    start,
+                )
+                for i in range(processes)
+            ]
+            with multiprocessing.Pool(processes) as pool:
+                results = pool.map(worker, jobs)
+    total = processes * requests_
+    insert = max(r[0] for r in results)
+    lookup = max(r[1] for r in results)
+    hits = sum(r[2] for r in results)
+    errors = sum(r[3] for r in results)
+    return total / insert, total / lookup, hits / total, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--size", type=int, default=20000, help="body bytes")
+    parser.add_argument("--shard", action="store_true")
+    parser.add_argument(
+        "--backends",
+        nargs="*",
+        default=[b for b in cachestore.BACKENDS if b != "memory"],
+    )
+    args = parser.parse_args()
+
+    print(
+        f"{args.processes} processes x {args.requests} requests, "
+        f"{args.size} bytes, {'sharded' if args.shard else 'shared'} cache"
+    )
+    print(f"{'backend':12s} {'insert/s':>10s} {'lookup/s':>10s} {'hit':>6s} errors")
+    for backend in args.backends:
+        insert, lookup, hit, errors = run(
+            backend, args.processes, args.requests, args.size, args.shard
+        )
+        print(f"{backend:12s} {insert:10.0f} {lookup:10.0f} {hit:6.1%} {errors}")
+
+
+if __name__ == "__main__":
+    main()
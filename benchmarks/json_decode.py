@@ -0,0 +1,76 @@
+"""JSONのデコードの速さを、従来の経路(response.text→StringIO→pd.read_json)と比べる。
+
+    python -m benchmarks.json_decode [amedas_map.json [hourly.json]]
+
+ファイルを与えなければ、AMeDASの地図データ(約1300地点)とV501/V502形式の毎時データに似せた合成データを使う。
+"""
+
+import io
+import json
+import sys
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from airpollutionwatch import fastjson
+from airpollutionwatch.v50x import block
+
+
+def synthetic_amedas(n=1300):
+    rng = np.random.default_rng(0)
+    data = {}
+    for i in range(n):
+        data[str(11001 + i)] = {
+            "pressure": [round(1000 + rng.normal(), 1), 0],
+            "temp": [round(20 + rng.normal(), 1), 0],
+            "humidity": [int(rng.integers(30, 100)), 0],
+            "precipitation1h": [0.0, 0],
+            "wind": [round(abs(rng.normal(3)), 1), 0],
+            "windDirection": [int(rng.integers(0, 17)), 0],
+        }
+    return json.dumps(data).encode()
+
+
+def synthetic_hourly(n=100, items=15):
+    rng = np.random.default_rng(0)
+    data = {
+        str(i): {str(j): f"{rng.random():.3f}" for j in range(items)} for i in range(n)
+    }
+    return json.dumps(data).encode()
+
+
+def bench(label, func, number=20):
+    seconds = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print(f"{label:40s} {seconds * 1000:8.2f} ms")
+    return seconds
+
+
+def main():
+    amedas = open(sys.argv[1], "rb").read() if len(sys.argv) > 1 else synthetic_amedas()
+    hourly = open(sys.argv[2], "rb").read() if len(sys.argv) > 2 else synthetic_hourly()
+    print(f"decoder: {fastjson.loads.__module__}")
+
+    print(f"AMeDAS map ({len(amedas)} bytes)")
+    old = bench(
+        "read_json(StringIO(text))",
+        lambda: pd.read_json(io.StringIO(amedas.decode()), orient="index"),
+    )
+    new = bench("fastjson.records(content)", lambda: fastjson.records(amedas))
+    print(f"{'speedup':40s} {old / new:8.1f} x")
+
+    print(f"V501/V502 hourly ({len(hourly)} bytes)")
+    old = bench(
+        "read_json(StringIO(text)).transpose()",
+        lambda: pd.read_json(io.StringIO(hourly.decode()))
+        .transpose()
+        .apply(pd.to_numeric, errors="coerce"),
+    )
+    new = bench(
+        "v50x.block(fastjson.loads(content))", lambda: block(fastjson.loads(hourly))
+    )
+    print(f"{'speedup':40s} {old / new:8.1f} x")
+
+
+if __name__ == "__main__":
+    main()
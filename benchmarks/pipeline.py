@@ -0,0 +1,276 @@
+"""記録した応答を使って、取得から変換までの各段階の時間とメモリを測る。
+
+    python -m benchmarks.pipeline fixtures 2024-09-01T01:00+09:00 2024-09-03T00:00+09:00
+    python -m benchmarks.pipeline fixtures ... --save-baseline benchmarks/baseline.json
+    python -m benchmarks.pipeline fixtures ... --baseline benchmarks/baseline.json
+
+fixturesはreplay record(またはbenchmarks.synthetic)で作ったディレクトリ。
+replayのスタンドインサーバから取得するので、ネットワークには出ない。
+
+段階は次のとおり。入れ子になった段階の時間は内側の段階に数える。
+    fetch    HTTPの取得(キャッシュを含む)
+    parse    JSON/HTMLの解析(fastjson, htmltable, v50x.block)
+    resolve  測定局コード・測定量コードの名前への変換と、国環研局番の解決
+    convert  単位の変換
+    assemble pd.concatとset_index
+    other    上のどれにも入らない残り(AMeDASの[値, 品質]の展開など)
+
+1時間ずつの取得(hour)も期間全体の並行取得(batch)も、repeat回の中央値を出す。
+batchの段階ごとの時間はスレッドの合計なので、totalより大きくなることがある。
+--baselineを与えると、基準より閾値以上遅くなった(または大きくなった)項目を表示して終了コード1を返す。
+比べるのはhourの各段階とbatchのtotal、peak_mbだけ。batchの段階ごとの時間はばらつきが大きすぎる。
+"""
+
+import argparse
+import functools
+import json
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+
+import pandas as pd
+import requests_cache
+
+from airpollutionwatch import batch, convert, fastjson, framecache, htmltable, memo
+from airpollutionwatch import replay, session, v50x
+
+STAGES = ["fetch", "parse", "resolve", "convert", "assemble", "other"]
+
+# 基準と比べて、これだけ遅く(大きく)なったら退行とみなす。
+THRESHOLD = 0.2
+
+# 測定のゆらぎで退行と判定しないように、これより小さい差は無視する。
+MIN_SECONDS = 0.005
+MIN_MB = 0.5
+
+# 基準と比べる項目
+GATED = {"hour": STAGES + ["total", "peak_mb"], "batch": ["total", "peak_mb"]}
+
+
+class Profile:
+    """段階ごとの時間を、入れ子の内側を差しひいて積算する。"""
+
+    def __init__(self):
+        self.seconds = defaultdict(float)
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def reset(self):
+        with self.lock:
+            self.seconds.clear()
+
+    def wrap(self, stage, func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            stack = self.local.__dict__.setdefault("stack", [])
+            stack.append(0.0)
+            t0 = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - t0
+                inner = stack.pop()
+                if stack:
+                    stack[-1] += elapsed
+                with self.lock:
+                    self.seconds[stage] += elapsed - inner
+
+        return wrapper
+
+
+def _targets(module):
+    """計測のために差しかえる(オブジェクト, 属性名, 段階)。"""
+    targets = [
+        (requests_cache.CachedSession, "request", "fetch"),
+        (fastjson, "loads", "parse"),
+        (fastjson, "records", "parse"),
+        (htmltable, "parse", "parse"),
+        (htmltable, "table", "parse"),
+        (v50x, "block", "parse"),
+        (v50x, "loads", "parse"),
+        (v50x, "records", "parse"),
+        (v50x.V50xSource, "_station_map", "resolve"),
+        (v50x.V50xSource, "_item_map", "resolve"),
+        (pd, "concat", "assemble"),
+        (pd.DataFrame, "set_index", "assemble"),
+    ]
+    for owner in (convert, v50x, module):
+        if hasattr(owner, "STATION"):
+            targets.append((owner, "STATION", "resolve"))
+    for name, stage in (
+        ("records", "parse"),
+        ("loads", "parse"),
+        ("block", "parse"),
+        ("_station_table", "resolve"),
+    ):
+        if hasattr(module, name):
+            targets.append((module, name, stage))
+    return targets
+
+
+class instrumented:
+    """withの間だけ、moduleの各段階の関数を計測つきに差しかえる。"""
+
+    def __init__(self, module, profile):
+        self.module = module
+        self.profile = profile
+        self.saved = []
+
+    def __enter__(self):
+        for owner, name, stage in _targets(self.module):
+            # 継承したメソッドは、もどすときに属性を消せばよい。
+            own = owner.__dict__.get(name)
+            self.saved.append((owner, name, own))
+            setattr(owner, name, self.profile.wrap(stage, getattr(owner, name)))
+        converters = self.module.converters
+        self.saved_converters = dict(converters)
+        for name, func in self.saved_converters.items():
+            converters[name] = self.profile.wrap("convert", func)
+        return self.profile
+
+    def __exit__(self, *exc):
+        for owner, name, own in reversed(self.saved):
+            if own is None:
+                delattr(owner, name)
+            else:
+                setattr(owner, name, own)
+        self.saved = []
+        self.module.converters.update(self.saved_converters)
+
+
+def _measure(func, profile):
+    """funcを1回実行し、{段階: 秒, total: 秒, rows: 行数}を返す。"""
+    profile.reset()
+    # 同じ時間をくりかえし取得するので、変換済みのDataFrameを使いまわさせない。
+    framecache.clear()
+    t0 = time.perf_counter()
+    df = func()
+    total = time.perf_counter() - t0
+    result = {stage: profile.seconds.get(stage, 0.0) for stage in STAGES[:-1]}
+    result["other"] = max(0.0, total - sum(result.values()))
+    result["total"] = total
+    result["rows"] = len(df)
+    return result
+
+
+def _peak_mb(func):
+    framecache.clear()
+    tracemalloc.start()
+    try:
+        func()
+        return tracemalloc.get_traced_memory()[1] / 2**20
+    finally:
+        tracemalloc.stop()
+
+
+def _fresh_session():
+    # 取得のたびにスタンドインサーバまで取りにいくように、キャッシュしない。
+    # (要求ごとの有効期限はセッションのexpire_afterより優先されるので、メソッドで外す)
+    session.set_session(session.new_session(backend="memory", allowable_methods=()))
+
+
+def bench_source(name, start, end, repeat=3, max_workers=batch.MAX_WORKERS):
+    """取得元nameについて、1時間ずつの取得と期間全体の取得を測る。"""
+    module = replay._module(name)
+    times = batch.hours(start, end)
+    profile = Profile()
+    _fresh_session()
+    memo.refresh()
+    # 測定局一覧などのメタデータは、ふだんの運用と同じくメモされた状態で測る。
+    module.retrieve(times[0])
+
+    with instrumented(module, profile):
+        runs = [
+            _measure(lambda: module.retrieve(t), profile)
+            for _ in range(repeat)
+            for t in times
+        ]
+        hour = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+        hour["peak_mb"] = _peak_mb(lambda: module.retrieve(times[0]))
+
+        whole = lambda: module.retrieve_range(start, end, max_workers=max_workers)
+        # batchはスレッドのばらつきが大きいので、これもrepeat回の中央値にする。
+        periods = [_measure(whole, profile) for _ in range(repeat)]
+        period = {
+            key: statistics.median(run[key] for run in periods) for key in periods[0]
+        }
+        period["hours"] = len(times)
+        period["peak_mb"] = _peak_mb(whole)
+    return {"hour": hour, "batch": period}
+
+
+def run(directory, start, end, sources=replay.SOURCES, repeat=3):
+    previous = session._session
+    results = {}
+    try:
+        with replay.StandIn(directory):
+            for name in sources:
+                results[name] = bench_source(name, start, end, repeat=repeat)
+    finally:
+        session.set_session(previous)
+        memo.refresh()
+    return results
+
+
+def table(results):
+    rows = {
+        (name, mode): values
+        for name, modes in results.items()
+        for mode, values in modes.items()
+    }
+    df = pd.DataFrame.from_dict(rows, orient="index")
+    seconds = STAGES + ["total"]
+    df[seconds] = df[seconds] * 1000
+    df = df.rename(columns={key: f"{key} ms" for key in seconds})
+    return df.round(2)
+
+
+def regressions(results, baseline, threshold=THRESHOLD):
+    """基準より遅く(大きく)なった項目を(取得元, 種類, 項目, 基準, 今回)で返す。"""
+    found = []
+    for name, modes in results.items():
+        for mode, values in modes.items():
+            base = baseline.get(name, {}).get(mode, {})
+            for key in GATED[mode]:
+                if key not in base:
+                    continue
+                margin = MIN_MB if key == "peak_mb" else MIN_SECONDS
+                if values[key] > base[key] * (1 + threshold) + margin:
+                    found.append((name, mode, key, base[key], values[key]))
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("start")
+    parser.add_argument("end")
+    parser.add_argument("--sources", nargs="*", default=replay.SOURCES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--baseline")
+    parser.add_argument("--save-baseline")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    results = run(args.directory, args.start, args.end, args.sources, args.repeat)
+    with pd.option_context("display.width", 200, "display.max_columns", None):
+        print(table(results))
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.threshold)
+        for name, mode, key, base, value in found:
+            print(f"REGRESSION {name} {mode} {key}: {base:.4g} -> {value:.4g}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,239 @@
+"""ベンチマーク用の合成fixtureを作る。
+
+本物の応答を記録できない環境でも、replayのスタンドインサーバで
+全取得元のパイプラインを動かせるように、形式だけ本物にそろえた応答を作って記録する。
+
+    python -m benchmarks.synthetic fixtures 2024-09-01T01:00+09:00 2024-09-03T00:00+09:00
+"""
+
+import argparse
+import datetime
+import io
+import json
+import re
+import urllib.parse
+import zlib
+
+import numpy as np
+import requests
+import urllib3
+
+from airpollutionwatch import registry, replay, session
+from airpollutionwatch import tokyo, kanagawa, yamanashi, chiba, shizuoka
+
+# ホストごとの取得元
+HOSTS = {
+    urllib.parse.urlsplit(module.BASE_URL).hostname: module
+    for module in (tokyo, kanagawa, yamanashi, chiba, shizuoka)
+}
+
+# AMeDASの地点数
+AMEDAS_STATIONS = 1300
+
+
+def _rng(text):
+    return np.random.default_rng(zlib.crc32(text.encode()))
+
+
+def _names(module, n=60):
+    """その都道府県の測定局名。別名も混ぜておく。"""
+    arrays = registry.load()
+    names = list(arrays["name"][arrays["pref"] == module.PREF][:n])
+    return list(module.aliases)[:10] + names
+
+
+def v501(module):
+    return {str(i + 1): {"name": name} for i, name in enumerate(_names(module))}
+
+
+def v502(module):
+    return {
+        str(i + 1): {"simpleName": name} for i, name in enumerate(module.converters)
+    }
+
+
+def hourly(module, url):
+    rng = _rng(url)
+    stations = v501(module)
+    items = v502(module)
+    data = {}
+    for code in stations:
+        data[code] = {
+            item: f"{rng.random() * 0.1:.3f}" if rng.random() > 0.1 else ""
+            for item in items
+        }
+        for item, value in items.items():
+            if value["simpleName"] in ("風向", "WD"):
+                data[code][item] = int(rng.integers(0, 17))
+    return data
+
+
+def html_table(headers, rows, form):
+    head = "".join(f"<th>{h}</th>" for h in headers)
+    body = "".join(
+        "<tr>" + "".join(f"<td>{cell}</td>" for cell in row) + "</tr>" for row in rows
+    )
+    return (
+        f"<html><body><form>{form}</form>"
+        f"<table><thead><tr>{head}</tr></thead><tbody>{body}</tbody></table>"
+        "</body></html>"
+    )
+
+
+def report(module, url, form):
+    rng = _rng(url + form)
+    headers = list(module.converters)
+    rows = []
+    for name in _names(module):
+        row = []
+        for header in headers:
+            if header in ("測定局", "測定局名"):
+                row.append(name)
+            elif header == "WD 方位":
+                row.append(["N", "NE", "S", "CALM", ""][int(rng.integers(0, 5))])
+            else:
+                row.append(f"{rng.random() * 0.1:.3f}")
+        rows.append(row)
+    return html_table(headers, rows, form)
+
+
+def amedas_table():
+    return {
+        str(11001 + i): {
+            "type": "A",
+            "elems": "11111111",
+            "lat": [24 + i % 21, (i * 7) % 60 + 0.1],
+            "lon": [123 + i % 23, (i * 3) % 60 + 0.5],
+            "alt": i % 800,
+            "kjName": f"地点{i}",
+            "knName": "",
+            "enName": f"Point{i}",
+        }
+        for i in range(AMEDAS_STATIONS)
+    }
+
+
+def amedas_map(url):
+    rng = _rng(url)
+    data = {}
+    for i in range(AMEDAS_STATIONS):
+        record = {"pressure": [round(1000 + rng.normal(), 1), 0]}
+        if i % 3:
+            record["temp"] = [round(20 + rng.normal(), 1), 0]
+            record["humidity"] = [int(rng.integers(30, 100)), 0]
+        if i % 2:
+            record["wind"] = [round(abs(rng.normal(3)), 1), 0]
+            record["windDirection"] = [int(rng.integers(0, 17)), 0]
+        data[str(11001 + i)] = record
+    return data
+
+
+def amedas_point(url):
+    rng = _rng(url)
+    first = datetime.datetime.strptime(url.rsplit("/", 1)[1], "%Y%m%d_%H.json")
+    data = {}
+    for i in range(18):
+        t = first + datetime.timedelta(minutes=10 * i)
+        data[t.strftime("%Y%m%d%H%M%S")] = {
+            "pressure": [round(1000 + rng.normal(), 1), 0],
+            "temp": [round(20 + rng.normal(), 1), 0],
+            "humidity": [int(rng.integers(30, 100)), 0],
+            "wind": [round(abs(rng.normal(3)), 1), 0],
+            "windDirection": [int(rng.integers(0, 17)), 0],
+        }
+    return data
+
+
+def respond(request):
+    """要求に対する合成の応答。(Content-Type, 本文)を返す。"""
+    url = request.url
+    parts = urllib.parse.urlsplit(url)
+    if parts.hostname == "www.jma.go.jp":
+        if url.endswith("amedastable.json"):
+            return "application/json", json.dumps(amedas_table()).encode()
+        if "/data/point/" in url:
+            return "application/json", json.dumps(amedas_point(url)).encode()
+        return "application/json", json.dumps(amedas_map(url)).encode()
+    module = HOSTS[parts.hostname]
+    if module is chiba:
+        query = dict(urllib.parse.parse_qsl(parts.query))
+        form = (
+            f'<input name="day" value="{query["day"]}">'
+            f'<select name="hour"><option value="{query["hour"]}" selected>'
+            f'{query["hour"]}</option></select>'
+        )
+        return "text/html; charset=utf-8", report(module, url, form).encode()
+    if module is shizuoka:
+        body = (
+            request.body.decode() if isinstance(request.body, bytes) else request.body
+        )
+        query = dict(urllib.parse.parse_qsl(body))
+        form = (
+            f'<input name="date" value="{query["date"]}">'
+            f'<input name="time" value="{query["time"]}">'
+        )
+        return "text/html; charset=utf-8", report(module, url, form).encode()
+    if url.endswith("V501Station.json"):
+        data = v501(module)
+    elif url.endswith("V502Item.json"):
+        data = v502(module)
+    elif re.search(r"/\d{10}\.json$", url):
+        data = hourly(module, url)
+    else:
+        raise KeyError(url)
+    return "application/json", json.dumps(data, ensure_ascii=False).encode()
+
+
+class SyntheticAdapter(requests.adapters.BaseAdapter):
+    """ネットワークに出ずに、respond()の応答を返すアダプタ。"""
+
+    def send(self, request, **kwargs):
+        content_type, content = respond(request)
+        headers = {"Content-Type": content_type}
+        response = requests.Response()
+        response.status_code = 200
+        response.raw = urllib3.HTTPResponse(
+            body=io.BytesIO(content),
+            headers=headers,
+            status=200,
+            preload_content=False,
+            request_url=request.url,
+        )
+        response._content = content
+        response.headers.update(headers)
+        response.encoding = "utf-8"
+        response.url = request.url
+        response.request = request
+        return response
+
+    def close(self):
+        pass
+
+
+def generate(directory, start, end, sources=replay.SOURCES):
+    """startからendまでの毎時について、合成の応答をdirectoryに記録する。"""
+    target = session.new_session(backend="memory")
+    target.mount("https://", SyntheticAdapter())
+    previous = session._session
+    session.set_session(target)
+    stop = replay.record(directory, target)
+    try:
+        for name in sources:
+            replay._module(name).retrieve_range(start, end)
+    finally:
+        stop()
+        session.set_session(previous)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("directory")
+    parser.add_argument("start")
+    parser.add_argument("end")
+    parser.add_argument("--sources", nargs="*", default=replay.SOURCES)
+    args = parser.parse_args()
+    generate(args.directory, args.start, args.end, args.sources)
+
+
+if __name__ == "__main__":
+    main()